@@ -9,12 +9,20 @@
 #
 # code taken from https://github.com/Praznat/annotationmodeling/blob/master/agreement.py
 
+import os
+import abc
+import weakref
+from collections import OrderedDict
 from multiprocessing import Pool
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import scipy.stats as stats
+from scipy.special import ndtr
 from itertools import chain
 
+from src.utils.parallel import worker_state, map_with_shared_state
+
 def flatten(listoflists):
     return list(chain.from_iterable(listoflists))
 
@@ -22,6 +30,137 @@ def halfwhere(whereM):
     half_indices = whereM[0] > whereM[1]
     return (whereM[0][half_indices], whereM[1][half_indices])
 
+def _group_positions(items):
+    """
+    Sort annotations by item (stably) and locate each item's group of annotations
+
+    Returns the sorting order, and for each sorted position the start of its item's group and its rank within the group
+    """
+    codes = np.unique(np.asarray(items), return_inverse=True)[1].ravel()
+    order = np.argsort(codes, kind="stable")
+    sizes = np.bincount(codes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    group_start = np.repeat(starts, sizes)
+    rank = np.arange(len(order)) - group_start
+    return order, group_start, rank
+
+def _unsort_pairs(order, rows, cols):
+    """Map pairs of sorted positions back to original indices as (larger, smaller) index pairs in row-major order"""
+    a, b = order[rows], order[cols]
+    i, j = np.maximum(a, b), np.minimum(a, b)
+    if not np.all(order[:-1] < order[1:]):
+        idx = np.lexsort((j, i))
+        i, j = i[idx], j[idx]
+    return i, j
+
+def get_same_item_pairs(items):
+    """
+    Enumerate (i, j) index pairs with i > j of annotations of the same item
+
+    Equivalent to `halfwhere(np.where(same_item_mask))` but built from the item groups,
+    so cost and memory scale with the number of within-item pairs instead of len(items)**2.
+    """
+    order, group_start, rank = _group_positions(items)
+    # each sorted position r pairs with the `rank[r]` preceding positions of its group
+    rows = np.repeat(np.arange(len(order)), rank)
+    cols = np.repeat(group_start, rank) + np.arange(len(rows)) - np.repeat(np.cumsum(rank) - rank, rank)
+    return _unsort_pairs(order, rows, cols)
+
+def get_different_item_pairs(items):
+    """Enumerate all (i, j) index pairs with i > j of annotations of different items (requires memory linear in their number)"""
+    order, group_start, _ = _group_positions(items)
+    # in sorted order, position r pairs with all positions before the start of its group
+    rows = np.repeat(np.arange(len(order)), group_start)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(group_start) - group_start, group_start)
+    return _unsort_pairs(order, rows, cols)
+
+def count_different_item_pairs(items):
+    _, group_start, _ = _group_positions(items)
+    return int(group_start.sum())
+
+def _choice_without_replacement(rng, n, size):
+    """Draw `size` distinct integers from range(n) uniformly (sorted), in memory linear in `size` rather than `n`"""
+    if size > n // 2:
+        return np.sort(rng.permutation(n)[:size])
+    result = np.unique(rng.choice(n, size=size))
+    while len(result) < size:
+        result = np.unique(np.concatenate([result, rng.choice(n, size=size - len(result))]))
+    return result
+
+def sample_different_item_pairs(items, size, replace=True, random_state=None):
+    """
+    Sample (i, j) index pairs with i > j of annotations of different items uniformly
+
+    Uses numpy's global random state unless a seed or `np.random.Generator` is passed as `random_state`.
+
+    Pairs are drawn by index in the (virtual) enumeration of `get_different_item_pairs`
+    and decoded without materializing the enumeration.
+    For annotations sorted by item, this draws the same pairs as
+    `np.random.choice(np.arange(n_pairs), size=size)` applied to `get_different_item_pairs(items)`.
+    """
+    order, group_start, _ = _group_positions(items)
+    cum_pairs = np.cumsum(group_start)
+    rng = np.random if random_state is None else np.random.default_rng(random_state)
+    n_pairs = int(cum_pairs[-1]) if len(cum_pairs) else 0
+    if replace:
+        pair_idxs = rng.choice(n_pairs, size=size, replace=True)
+    else:
+        pair_idxs = _choice_without_replacement(rng, n_pairs, size)
+    rows = np.searchsorted(cum_pairs, pair_idxs, side="right")
+    cols = pair_idxs - (cum_pairs[rows] - group_start[rows])
+    a, b = order[rows], order[cols]
+    return np.maximum(a, b), np.minimum(a, b)
+
+def _count_earlier_same_item(items):
+    """For each annotation, the number of annotations of the same item preceding it"""
+    order, _, rank = _group_positions(items)
+    result = np.empty(len(order), dtype=np.int64)
+    result[order] = rank
+    return result
+
+def get_new_different_item_pairs(items, n_old):
+    """Enumerate all (i, j) index pairs with i > j of annotations of different items where i >= n_old (i.e., that involve annotations appended after the first `n_old`)"""
+    new_rows = np.arange(n_old, len(items))
+    rows = np.repeat(new_rows, new_rows)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(new_rows) - new_rows, new_rows)
+    items = np.asarray(items)
+    keep = items[rows] != items[cols]
+    return rows[keep], cols[keep]
+
+def sample_new_different_item_pairs(items, n_old, size, replace=True, random_state=None):
+    """Sample (i, j) index pairs with i > j of annotations of different items where i >= n_old uniformly"""
+    rng = np.random.default_rng(random_state)
+    items = np.asarray(items)
+    new_rows = np.arange(n_old, len(items))
+    # annotation i pairs with the i annotations before it, except those of the same item
+    n_partners = new_rows - _count_earlier_same_item(items)[n_old:]
+    cum_partners = np.cumsum(n_partners)
+    if size == 0 or len(cum_partners) == 0 or cum_partners[-1] == 0:
+        assert size == 0, "no pairs of different items involve new annotations"
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if not replace:
+        assert size <= cum_partners[-1], "cannot sample more pairs than there are without replacement"
+        if size > cum_partners[-1] // 2:
+            rows, cols = get_new_different_item_pairs(items, n_old)
+            idx = np.sort(rng.permutation(len(rows))[:size])
+            return rows[idx], cols[idx]
+        # draw with replacement and redraw duplicates
+        rows, cols = sample_new_different_item_pairs(items, n_old, size, random_state=rng)
+        while True:
+            first = np.sort(np.unique(rows * len(items) + cols, return_index=True)[1])
+            if len(first) == size:
+                return rows, cols
+            more_rows, more_cols = sample_new_different_item_pairs(items, n_old, size - len(first), random_state=rng)
+            rows, cols = np.concatenate([rows[first], more_rows]), np.concatenate([cols[first], more_cols])
+    rows = new_rows[np.searchsorted(cum_partners, rng.integers(0, cum_partners[-1], size=size), side="right")]
+    # draw partners uniformly among the preceding annotations and redraw those of the same item
+    cols = np.zeros(size, dtype=np.int64)
+    redraw = np.arange(size)
+    while len(redraw):
+        cols[redraw] = rng.integers(0, rows[redraw])
+        redraw = redraw[items[cols[redraw]] == items[rows[redraw]]]
+    return rows, cols
+
 def dist_pardo(i, j, label_i, label_j, dist_fn):
     return i, j, (dist_fn(label_i, label_j) if i > j else np.nan)
 
@@ -33,32 +172,267 @@ def get_distance_matrix_singlethreaded(all_labels, dist_fn, label_ij=None):
         return np.array(label_distances)
     else:
         result = np.nan * np.ones((len(all_labels), len(all_labels)))
-        for a, b in zip(label_ij[0], label_ij[1]):
-            result[a, b] = dist_fn(all_labels[a], all_labels[b])
+        result[label_ij] = get_pair_distances(all_labels, dist_fn, label_ij)
         return result
 
-def get_distance_matrix(all_labels, dist_fn, label_ij=None):
-    result = np.nan * np.ones((len(all_labels), len(all_labels)))
+def _pair_distances(all_labels, dist_fn, rows, cols):
+    return np.array([dist_fn(all_labels[a], all_labels[b]) for a, b in zip(rows, cols)], dtype=float)
+
+_distance_worker_state = {}
+
+def _init_distance_worker(all_labels, dist_fn):
+    _distance_worker_state["all_labels"] = all_labels
+    _distance_worker_state["dist_fn"] = dist_fn
+
+def _distance_chunk(label_ij):
+    return _pair_distances(_distance_worker_state["all_labels"], _distance_worker_state["dist_fn"], *label_ij)
+
+def _resolve_n_jobs(n_jobs):
+    """Number of worker processes for `n_jobs` (None or -1: all CPU cores)"""
+    return os.cpu_count() if n_jobs in (None, -1) else n_jobs
+
+def _shutdown_pool(pool):
+    pool.close()
+    pool.join()
+
+class DistancePool():
+    """
+    Persistent worker pool for computing pairwise label distances
+
+    The labels and the distance function are shipped to the workers once when the pool starts
+    (and the pool is only restarted when called with a different label array or distance function),
+    and pairs are handed out as contiguous chunks of index arrays instead of one task per pair.
+    The workers are shut down by `close` (or when leaving a `with` block), and at the latest
+    when the pool object is garbage collected.
+    """
+    def __init__(self, n_jobs=None, chunks_per_job=4):
+        self.n_jobs = _resolve_n_jobs(n_jobs)
+        self.chunks_per_job = chunks_per_job
+        self._pool = None
+        self._finalizer = None
+        self._all_labels = None
+        self._dist_fn = None
+
+    def _get_pool(self, all_labels, dist_fn):
+        if self._pool is None or self._all_labels is not all_labels or self._dist_fn is not dist_fn:
+            self.close()
+            self._pool = Pool(self.n_jobs, initializer=_init_distance_worker, initargs=(all_labels, dist_fn))
+            self._finalizer = weakref.finalize(self, _shutdown_pool, self._pool)
+            self._all_labels, self._dist_fn = all_labels, dist_fn
+        return self._pool
+
+    def compute(self, all_labels, dist_fn, label_ij):
+        """Return the distances of the (i, j) index pairs in `label_ij`"""
+        rows, cols = np.asarray(label_ij[0]), np.asarray(label_ij[1])
+        if len(rows) == 0:
+            return np.empty(0)
+        n_chunks = min(len(rows), self.n_jobs * self.chunks_per_job)
+        bounds = np.linspace(0, len(rows), n_chunks + 1).astype(int)
+        chunks = [(rows[s:e], cols[s:e]) for s, e in zip(bounds[:-1], bounds[1:])]
+        return np.concatenate(self._get_pool(all_labels, dist_fn).map(_distance_chunk, chunks))
+
+    def close(self):
+        if self._finalizer is not None:
+            # shuts down the workers (once)
+            self._finalizer()
+        self._pool = None
+        self._finalizer = None
+        self._all_labels = None
+        self._dist_fn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def get_distance_matrix(all_labels, dist_fn, label_ij=None, pool=None):
+    """
+    Compute the distance matrix in parallel (lower triangle, NaN elsewhere)
 
+    Pass a `DistancePool` to reuse its workers across calls; otherwise a temporary pool is used.
+    """
+    result = np.nan * np.ones((len(all_labels), len(all_labels)))
     if label_ij is None:
-        label_range = range(len(all_labels))
-        args = flatten([[(a, b, all_labels[a], all_labels[b], dist_fn) for a in label_range] for b in label_range])
+        label_ij = np.tril_indices(len(all_labels), -1)
+    if pool is None:
+        with DistancePool() as pool:
+            result[label_ij] = pool.compute(all_labels, dist_fn, label_ij)
     else:
-        args = [(a, b, all_labels[a], all_labels[b], dist_fn) for a, b in zip(label_ij[0], label_ij[1])]
-    with Pool() as p:
-        reduced = p.starmap(dist_pardo, args)
-
-    for item in reduced:
-        result[item[0], item[1]] = item[2]
+        result[label_ij] = pool.compute(all_labels, dist_fn, label_ij)
     return result
 
+def _hashable(label):
+    """Canonicalize a label to a hashable key (lists, tuples and arrays become tuples, dicts sorted item tuples, sets frozensets)"""
+    if isinstance(label, np.ndarray):
+        label = label.tolist()
+    if isinstance(label, (list, tuple)):
+        return tuple(_hashable(x) for x in label)
+    if isinstance(label, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in label.items()))
+    if isinstance(label, (set, frozenset)):
+        return frozenset(_hashable(x) for x in label)
+    return label
+
+class DistanceCache():
+    """
+    Bounded (LRU) memo of distances between label values
+
+    Labels are canonicalized to hashable keys, and each batch of pairs is reduced to its unique
+    (label_a, label_b) key pairs, so `dist_fn` is only called once per distinct pair of label values.
+    The labels' key codes are memoized for the last label array (see `encode`).
+    `hits` counts the pairs served without calling `dist_fn`, `misses` the calls made.
+    """
+    def __init__(self, dist_fn, maxsize=1_000_000):
+        self.dist_fn = dist_fn
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._labels = None
+        self._label_codes = None
+        self._key_codes = {}
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self._labels = None
+        self._label_codes = None
+        self._key_codes = {}
+
+    def encode(self, all_labels, n_known=0):
+        """
+        Codes of the labels' canonical keys
+
+        Memoized for the last label array passed. If `all_labels` extends that array by appended
+        labels, pass the number of labels it had as `n_known` to only canonicalize the new ones.
+        """
+        if all_labels is self._labels:
+            return self._label_codes
+        if self._labels is None or not 0 < n_known <= len(self._label_codes):
+            n_known = 0
+            self._key_codes = {}
+        new_codes = [self._key_codes.setdefault(_hashable(label), len(self._key_codes)) for label in all_labels[n_known:]]
+        self._label_codes = np.concatenate([self._label_codes[:n_known] if n_known else np.empty(0, dtype=np.int64), np.array(new_codes, dtype=np.int64)])
+        self._labels = all_labels
+        return self._label_codes
+
+    def compute(self, all_labels, label_ij, pool=None):
+        """Return the distances of the (i, j) index pairs in `label_ij`, computing only those of label value pairs not seen before"""
+        rows, cols = np.asarray(label_ij[0], dtype=np.int64), np.asarray(label_ij[1], dtype=np.int64)
+        if len(rows) == 0:
+            return np.empty(0)
+        label_codes = self.encode(all_labels)
+        keys = list(self._key_codes)
+
+        # reduce the pairs to unique (label_a, label_b) key pairs
+        pair_codes = label_codes[rows] * len(keys) + label_codes[cols]
+        unique_codes, first, inverse = np.unique(pair_codes, return_index=True, return_inverse=True)
+        unique_keys = [(keys[c // len(keys)], keys[c % len(keys)]) for c in unique_codes.tolist()]
+
+        values = np.empty(len(unique_codes))
+        missing = []
+        for u, key in enumerate(unique_keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                values[u] = self._cache[key]
+            else:
+                missing.append(u)
+        if missing:
+            # compute each missing key pair at one of its original index pairs
+            missing_ij = (rows[first[missing]], cols[first[missing]])
+            values[missing] = get_pair_distances(all_labels, self.dist_fn, missing_ij, pool)
+            for u in missing:
+                self._cache[unique_keys[u]] = values[u]
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        self.misses += len(missing)
+        self.hits += len(rows) - len(missing)
+        return values[inverse.ravel()]
+
+def get_pair_distances(all_labels, dist_fn, label_ij, pool=None, cache=None, chunk_size=None):
+    """
+    Compute the distances of the (i, j) index pairs in `label_ij` as a vector aligned with the pairs
+
+    `dist_fn` is either a scalar function `dist_fn(label_a, label_b)` or a `BatchedDistance`, which
+    computes all pairs at once (and ignores `pool` and `cache`). For scalar functions, pass a
+    `DistancePool` to compute them in parallel, and a `DistanceCache` (built with the same `dist_fn`)
+    to reuse distances between repeated label values.
+    With `chunk_size`, pairs are processed in chunks of at most that many pairs (bounding temporary memory).
+    """
+    if chunk_size is not None and len(label_ij[0]) > chunk_size:
+        result = np.empty(len(label_ij[0]))
+        for start in range(0, len(result), chunk_size):
+            chunk_ij = (label_ij[0][start:start + chunk_size], label_ij[1][start:start + chunk_size])
+            result[start:start + chunk_size] = get_pair_distances(all_labels, dist_fn, chunk_ij, pool, cache)
+        return result
+    if isinstance(dist_fn, ScalarDistance):
+        dist_fn = dist_fn.dist_fn
+    elif isinstance(dist_fn, BatchedDistance):
+        return dist_fn.pairwise(all_labels, label_ij)
+    if cache is not None:
+        return cache.compute(all_labels, label_ij, pool)
+    if pool is not None:
+        return pool.compute(all_labels, dist_fn, label_ij)
+    return _pair_distances(all_labels, dist_fn, label_ij[0], label_ij[1])
+
 def get_pair_sets(values, same_item_ij):
-    ''' TODO refactor, this has the same pattern as get_distance_matrix '''
-    result = np.nan * np.ones((len(values), len(values), 2))
-    for a, b in zip(same_item_ij[0], same_item_ij[1]):
-        result[a][b] = np.array([values[a], values[b]])
-    vector = result[same_item_ij]
-    return [list([pair[0], pair[1]]) for pair in vector]
+    """Look up the values of the (i, j) index pairs as a (n_pairs, 2) array"""
+    values = np.asarray(values)
+    return np.column_stack([values[same_item_ij[0]], values[same_item_ij[1]]])
+
+def kde_cdf(kde, x, low=0, grid_size=None, chunk_size=10_000_000):
+    """
+    Vectorized `kde.integrate_box_1d(low, x)` of a 1-d `stats.gaussian_kde` for all values in `x`
+
+    Duplicate values in `x` and in the KDE's dataset are evaluated once,
+    and the (values x data) kernel matrix is processed in chunks of about `chunk_size` entries.
+    If `grid_size` is given and `x` has more unique values, the CDF is evaluated exactly on
+    `grid_size` evenly spaced points spanning `x` and linearly interpolated in between
+    (for large sets of continuous distances).
+    """
+    stdev = np.sqrt(kde.covariance[0, 0])
+    data, data_inverse = np.unique(kde.dataset[0], return_inverse=True)
+    weights = np.bincount(data_inverse.ravel(), weights=kde.weights, minlength=len(data))
+    values, inverse = np.unique(np.asarray(x, dtype=float), return_inverse=True)
+    if grid_size is not None and len(values) > grid_size:
+        grid = np.linspace(values[0], values[-1], grid_size)
+        return np.interp(values, grid, kde_cdf(kde, grid, low, chunk_size=chunk_size))[inverse.ravel()]
+    lower = ndtr((low - data) / stdev) @ weights
+    result = np.empty(len(values))
+    step = max(1, chunk_size // len(data))
+    for start in range(0, len(values), step):
+        result[start:start + step] = ndtr((values[start:start + step, None] - data) / stdev) @ weights - lower
+    return result[inverse.ravel()]
+
+def ks_greater_single(x, sample):
+    """
+    `1 - stats.ks_2samp([x_i], sample, alternative="greater").pvalue` for each x_i in `x`, computed at once
+
+    For a one-point sample the one-sided statistic is the fraction of `sample` above x_i, which
+    takes one `searchsorted` in the sorted sample. Its p-value follows `ks_2samp`'s method selection:
+    the exact distribution, (m - h + 1) / (m + 1) for h = round(D * m), if len(sample) <= 10000,
+    and Hodges' asymptotic approximation otherwise.
+    """
+    m = len(sample)
+    d = 1 - np.searchsorted(np.sort(sample), x, side="right") / m
+    if m <= 10000:
+        h = np.round(d * m)
+        prob = (m - h + 1.0) / (m + 1.0)
+    else:
+        en = m / (m + 1.0)
+        z = np.sqrt(en) * d
+        prob = np.exp(-2 * z**2 - 2 * z * (m + 2.0) / np.sqrt(m * (m + 1.0)) / 3.0)
+    return 1 - np.clip(prob, 0, 1)
 
 class DoDa():
 
@@ -76,7 +450,7 @@ class DoDa():
     def get_krippendorff_alpha(self):
         return 1 - self.observed_distances.mean() / self.expected_distances.mean()
 
-    def get_sigma(self, thresh=0.05, use_kde=True, debug=False):
+    def get_sigma(self, thresh=0.05, use_kde=True, debug=False, kde_grid_size=None):
         if use_kde:
             kde_De = stats.gaussian_kde(self.expected_distances)
             if debug:
@@ -84,7 +458,7 @@ class DoDa():
                 plt.scatter(self.expected_distances, kde_De.pdf(self.expected_distances), color="r", alpha=0.5)
                 plt.scatter(self.observed_distances, kde_Do.pdf(self.observed_distances), color="c", alpha=0.5)
                 plt.show()
-            pDeLtDo = np.array([kde_De.integrate_box_1d(0, d) for d in self.observed_distances])
+            pDeLtDo = kde_cdf(kde_De, self.observed_distances, grid_size=kde_grid_size)
             if debug:
                 plt.scatter(self.observed_distances, pDeLtDo)
                 self.plot_distance_distributions()
@@ -102,8 +476,85 @@ class DoDa():
         if fast:
             return stats.ks_2samp(d_o, d_e, alternative="greater").statistic
         else:
-            return np.mean([1 - stats.ks_2samp([x], d_e, alternative="greater").pvalue for x in d_o])
+            return np.mean(ks_greater_single(d_o, d_e))
+
+    def bootstrap(self, n_bootstrap=200, ci=0.95, n_jobs=None, random_state=None, use_kde=True, fast_ks=True):
+        """
+        Compute bootstrap confidence intervals for Krippendorff's alpha, sigma and KS
+
+        Each replicate resamples items with replacement and reweights the already computed
+        distances accordingly (an observed distance counts once per draw of its item, an expected
+        distance once per draw of both its items), so no distances are recomputed.
+        Expected distances without item information (e.g., precomputed ones) are kept fixed.
 
+        Args:
+        n_bootstrap: int
+            Number of bootstrap replicates
+        ci: float
+            Confidence level of the (percentile) intervals
+        n_jobs: int
+            Number of worker processes to distribute replicates across (None or 1: run sequentially, -1: use all CPU cores)
+        random_state: int
+            Seed for resampling items
+        use_kde, fast_ks: bool
+            Passed on to `get_sigma` and `get_ks`
+
+        Returns:
+        pd.DataFrame with the statistics ("alpha", "sigma", "ks") as index and "estimate", "lower" and "upper" columns
+        (the replicates' values are stored as `bootstrap_samples`)
+        """
+        assert self.observed_distances is not None and self.expected_distances is not None, "Distances must be computed before calling bootstrap"
+        assert getattr(self, "items_of_distances", None) is not None, "Items of the observed distances are required for bootstrapping"
+        assert n_bootstrap > 0, "n_bootstrap must be greater than 0"
+        assert 0 < ci < 1, "ci must be between 0 and 1"
+
+        # encode the items of the observed (and expected) distances as 0, ..., n_items-1
+        items_of_expected = getattr(self, "items_of_expected_distances", None)
+        observed_items = np.asarray(self.items_of_distances).reshape(-1, 2)[:, 0]
+        all_items = observed_items if items_of_expected is None else np.concatenate([observed_items, np.asarray(items_of_expected).ravel()])
+        item_values, codes = np.unique(all_items, return_inverse=True)
+        codes = codes.ravel()
+        state = {
+            "observed_distances": np.asarray(self.observed_distances),
+            "expected_distances": np.asarray(self.expected_distances),
+            "observed_items": codes[:len(observed_items)],
+            "expected_items": None if items_of_expected is None else codes[len(observed_items):].reshape(-1, 2).T,
+            "n_items": len(item_values),
+            "use_kde": use_kde,
+            "fast_ks": fast_ks,
+        }
+        seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(random_state).spawn(n_bootstrap)]
+        samples = pd.DataFrame(map_with_shared_state(_run_agreement_bootstrap_replicate, seeds, state, n_jobs=n_jobs), columns=["alpha", "sigma", "ks"])
+
+        estimates = [self.get_krippendorff_alpha(), self.get_sigma(use_kde=use_kde), self.get_ks(fast=fast_ks)]
+        q = [(1-ci)/2, 1-(1-ci)/2]
+        self.bootstrap_samples = samples
+        return pd.DataFrame(
+            np.column_stack([estimates, np.nanquantile(samples.values, q, axis=0).T]),
+            index=samples.columns, columns=["estimate", "lower", "upper"]
+        )
+
+def _run_agreement_bootstrap_replicate(seed):
+    rng = np.random.default_rng(seed)
+    n_items = worker_state["n_items"]
+    counts = np.bincount(rng.integers(0, n_items, size=n_items), minlength=n_items)
+    replicate = DoDa()
+    replicate.observed_distances = np.repeat(worker_state["observed_distances"], counts[worker_state["observed_items"]])
+    replicate.expected_distances = worker_state["expected_distances"]
+    if worker_state["expected_items"] is not None:
+        items_a, items_b = worker_state["expected_items"]
+        replicate.expected_distances = np.repeat(replicate.expected_distances, counts[items_a] * counts[items_b])
+    if len(replicate.observed_distances) == 0 or len(replicate.expected_distances) < 2:
+        return np.nan, np.nan, np.nan
+    return (
+        replicate.get_krippendorff_alpha(),
+        replicate.get_sigma(use_kde=worker_state["use_kde"]),
+        replicate.get_ks(fast=worker_state["fast_ks"]),
+    )
+
+
+# approximate memory held per expected distance: (i, j) indices, distance and the pair's items
+EXPECTED_PAIR_NBYTES = 40
 
 class InterAnnotatorAgreement(DoDa):
     @classmethod
@@ -113,10 +564,11 @@ class InterAnnotatorAgreement(DoDa):
         golddict = getattr(experiment, "golddict", None)
         return cls(experiment.annodf, experiment.item_colname, experiment.uid_colname, experiment.label_colname, distance_fn, golddict)
 
-    def __init__(self, annodf, item_colname, uid_colname, label_colname, distance_fn, golddict=None, verbose=False):
+    def __init__(self, annodf, item_colname, uid_colname, label_colname, distance_fn, golddict=None, verbose=False, cache_distances=False, cache_size=1_000_000):
         self.distance_fn = distance_fn
         self.annodf = annodf.sort_values(item_colname)
-        self.annodf = self.annodf.rename(columns={item_colname:'item', uid_colname:"worker", label_colname:"label"})
+        self._column_names = {item_colname:'item', uid_colname:"worker", label_colname:"label"}
+        self.annodf = self.annodf.rename(columns=self._column_names)
         self.items = self.annodf["item"].values
         self.workers = self.annodf["worker"].values
         self.all_labels = self.annodf["label"].values
@@ -124,54 +576,232 @@ class InterAnnotatorAgreement(DoDa):
         self.dist_from_gold = None
         self.observed_distances = None
         self.expected_distances = None
+        # distances are stored as vectors aligned with (i, j) index pairs into `annodf`
+        self.observed_ij = None
+        self.expected_ij = None
+        self.items_of_expected_distances = None
+        self._distance_matrix_fill = np.nan
         self.distance_matrix = None
         self.verbose = verbose
+        self._distance_pool = None
+        # opt-in memo of distances between identical label values (see `DistanceCache`)
+        self.distance_cache = DistanceCache(distance_fn, cache_size) if cache_distances else None
+
+    @property
+    def distance_matrix(self):
+        """
+        Dense view of the computed pairwise distances (built on demand from the stored pairs)
+
+        Only the lower triangle holds distances. Other entries are NaN if all
+        pairs were computed, and 0 if the expected distances were subsampled.
+        """
+        if getattr(self, "_distance_matrix", None) is not None:
+            return self._distance_matrix
+        if getattr(self, "expected_ij", None) is None:
+            return None
+        result = np.full((len(self.annodf), len(self.annodf)), self._distance_matrix_fill)
+        result[self.observed_ij] = self.observed_distances
+        result[self.expected_ij] = self.expected_distances
+        return result
+
+    @distance_matrix.setter
+    def distance_matrix(self, value):
+        self._distance_matrix = value
 
     def __getstate__(self):
-        to_serialize = ['observed_distances', 'expected_distances', 'distance_matrix', 'annodf', 'items_of_distances', 'workers_of_distances']
+        to_serialize = ['observed_distances', 'expected_distances', 'observed_ij', 'expected_ij', '_distance_matrix_fill', '_distance_matrix', 'annodf', 'items_of_distances', 'workers_of_distances', 'items_of_expected_distances']
         state = dict(self.__dict__)
         return {k:state.get(k) for k in to_serialize}
+
+    def __setstate__(self, state):
+        state = dict(state)
+        # objects pickled before distances were stored as pairs carry the dense matrix
+        if "distance_matrix" in state:
+            state["_distance_matrix"] = state.pop("distance_matrix")
+        self.__dict__.update(state)
     
-    def setup(self, subsample_expected_distances=True, parallel_calc=False, precomputed_observed_distances=None):
-        gdm = get_distance_matrix if parallel_calc else get_distance_matrix_singlethreaded
+    def close(self):
+        """Shut down the worker pool kept for `setup(parallel_calc=True)` (also done when leaving a `with` block)"""
+        if getattr(self, "_distance_pool", None) is not None:
+            self._distance_pool.close()
+        self._distance_pool = None
 
-        same_item = np.array([[np.nan if item_a != item_b else 1 for item_a in self.items] for item_b in self.items])
-        
-        same_item_ij = halfwhere(np.where(~np.isnan(same_item)))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def setup(self, subsample_expected_distances=True, parallel_calc=False, precomputed_observed_distances=None, n_jobs=None, random_state=None, n_expected_distances=None, memory_budget=None):
+        """
+        Compute the observed (within-item) and expected (between-item) distances
+
+        Expected distances are computed for all between-item pairs if `subsample_expected_distances`
+        is False, or else for a sample (with replacement) of `n_expected_distances` pairs (default:
+        as many as there are observed distances). Pairs are sampled by index, without enumerating
+        all between-item pairs, and seeded by `random_state` (default: numpy's global random state).
+        `memory_budget` (in bytes) caps the number of expected distances held to about
+        `memory_budget / EXPECTED_PAIR_NBYTES` and computes them in chunks; if all between-item pairs
+        do not fit, a sample (without replacement) of that size (or of `n_expected_distances` pairs,
+        if smaller) is drawn instead.
+        With `parallel_calc`, distances are computed in `n_jobs` worker processes (None or -1: all CPU cores),
+        and the worker pool is kept for subsequent calls (and restarted if `n_jobs` changes) until `close`
+        is called or the object is used as a context manager and the `with` block is left.
+        """
+        if parallel_calc:
+            # keep the pool (and the labels shipped to its workers) around for subsequent calls
+            if getattr(self, "_distance_pool", None) is None or self._distance_pool.n_jobs != _resolve_n_jobs(n_jobs):
+                self.close()
+                self._distance_pool = DistancePool(n_jobs)
+            pool = self._distance_pool
+        else:
+            pool = None
+
+        self.observed_ij = get_same_item_pairs(self.items)
         if self.verbose: print("Calculating same-item distances")
-        same_item_distM = gdm(self.all_labels, self.distance_fn, label_ij=same_item_ij)
-        self.observed_distances = same_item_distM[same_item_ij]
-        self.items_of_distances = get_pair_sets(self.items, same_item_ij)
-        self.workers_of_distances = get_pair_sets(self.workers, same_item_ij)
+        self.observed_distances = get_pair_distances(self.all_labels, self.distance_fn, self.observed_ij, pool, self.distance_cache)
+        self.items_of_distances = get_pair_sets(self.items, self.observed_ij)
+        self.workers_of_distances = get_pair_sets(self.workers, self.observed_ij)
         
         if precomputed_observed_distances is not None:
+            self.expected_ij = None
+            self.items_of_expected_distances = None
             self.expected_distances = precomputed_observed_distances
         else:
-            different_item = np.array([[np.nan if item_a == item_b else 1 for item_a in self.items] for item_b in self.items])
-            different_item_ij = halfwhere(np.where(~np.isnan(different_item)))
-            if subsample_expected_distances:
-                nsample = min(len(same_item_ij[0]), len(different_item_ij[0]))
-                sample_i = np.random.choice(np.arange(len(different_item_ij[0])), size=nsample)
-                different_item_ij = (different_item_ij[0][sample_i], different_item_ij[1][sample_i])
-                if self.verbose: print("Calculating different-item distances")
-                different_item_distM = gdm(self.all_labels, self.distance_fn, label_ij=different_item_ij)
-                same_item_nonnan = np.where(~np.isnan(same_item_distM))
-                different_item_nonnan = np.where(~np.isnan(different_item_distM))
-
-                self.distance_matrix = np.nansum([same_item_distM, different_item_distM], axis=0)
+            n_pairs = count_different_item_pairs(self.items)
+            max_pairs = n_pairs if memory_budget is None else min(n_pairs, int(memory_budget // EXPECTED_PAIR_NBYTES))
+            self._n_expected_distances = n_expected_distances
+            self._max_expected_distances = None if memory_budget is None else int(memory_budget // EXPECTED_PAIR_NBYTES)
+            # pairs are sampled with replacement if a subsample was asked for, and without if all pairs do not fit the budget
+            self._replace_expected_distances = subsample_expected_distances
+            self._subsample_expected_distances = subsample_expected_distances or n_pairs > max_pairs
+            if self._subsample_expected_distances:
+                nsample = self._get_n_expected_distances(n_pairs)
+                self.expected_ij = sample_different_item_pairs(self.items, nsample, replace=subsample_expected_distances, random_state=random_state)
+                self._distance_matrix_fill = 0.0
             else:
-                self.distance_matrix = gdm(self.all_labels, self.distance_fn)
-            self.expected_distances = self.distance_matrix[different_item_ij]
+                self.expected_ij = get_different_item_pairs(self.items)
+                self._distance_matrix_fill = np.nan
+            if self.verbose: print("Calculating different-item distances")
+            chunk_size = None if memory_budget is None else max(1, max_pairs // 8)
+            self.expected_distances = get_pair_distances(self.all_labels, self.distance_fn, self.expected_ij, pool, self.distance_cache, chunk_size)
+            self.items_of_expected_distances = get_pair_sets(self.items, self.expected_ij)
+            self._distance_matrix = None
+
+    def _get_n_expected_distances(self, n_pairs):
+        """Size of the sample of expected distances given `n_pairs` between-item pairs (see `setup`)"""
+        if self._n_expected_distances is not None:
+            nsample = self._n_expected_distances
+        elif self._replace_expected_distances:
+            nsample = len(self.observed_ij[0])
+        else:
+            # all pairs were asked for, but do not fit the memory budget
+            nsample = n_pairs
+        return min(nsample, n_pairs, self._max_expected_distances or n_pairs)
+
+    def add_annotations(self, annodf, random_state=None):
+        """
+        Add a batch of annotations and update the distances without recomputing existing ones
+
+        `annodf` must have the same columns as the data frame the object was created with. New
+        annotations are appended to `annodf` (which is therefore no longer sorted by item), and
+        distances are only computed for
+        - the within-item pairs that involve a new annotation (added to the observed distances), and
+        - the changes to the expected distances: with all pairs, the new between-item pairs are added.
+          With a subsample, each sampled pair is replaced by a pair involving a new annotation with
+          probability (number of such pairs) / (number of all between-item pairs), which keeps the
+          sample uniform over all between-item pairs, and the sample is topped up to the number of
+          observed distances. A sample drawn without replacement because all pairs do not fit the
+          `memory_budget` (also when they stop fitting after adding annotations) keeps a random subset
+          of the old pairs and adds new pairs in proportion to their number, up to the budget.
+        Expected distances passed as `precomputed_observed_distances` stay fixed.
+        Alpha, sigma and KS computed afterwards reflect all annotations.
+        """
+        assert self.observed_ij is not None, "setup must be called before adding annotations"
+        rng = np.random.default_rng(random_state)
+        pool = getattr(self, "_distance_pool", None)
+        n_old = len(self.items)
+        new_df = annodf.rename(columns=self._column_names).sort_values("item")
+        self.annodf = pd.concat([self.annodf, new_df])
+        self.items = self.annodf["item"].values
+        self.workers = self.annodf["worker"].values
+        self.all_labels = self.annodf["label"].values
+        self._distance_matrix = None
+        if self.distance_cache is not None:
+            # only canonicalize the new labels
+            self.distance_cache.encode(self.all_labels, n_known=n_old)
+
+        # within-item pairs involving new annotations (among the annotations of the items they annotate)
+        touched = np.flatnonzero(np.isin(self.items, new_df["item"].values))
+        i, j = get_same_item_pairs(self.items[touched])
+        i, j = touched[i], touched[j]
+        new_ij = (i[i >= n_old], j[i >= n_old])
+        if self.verbose: print("Calculating same-item distances")
+        self.observed_distances = np.concatenate([self.observed_distances, get_pair_distances(self.all_labels, self.distance_fn, new_ij, pool, self.distance_cache)])
+        self.observed_ij = tuple(np.concatenate([old, new]) for old, new in zip(self.observed_ij, new_ij))
+        self.items_of_distances = np.concatenate([self.items_of_distances, get_pair_sets(self.items, new_ij)])
+        self.workers_of_distances = np.concatenate([self.workers_of_distances, get_pair_sets(self.workers, new_ij)])
+
+        if self.expected_ij is None:
+            return
+        n_pairs = count_different_item_pairs(self.items)
+        n_old_pairs = count_different_item_pairs(self.items[:n_old])
+        if not self._subsample_expected_distances and n_pairs > (self._max_expected_distances or n_pairs):
+            # all pairs no longer fit the memory budget: continue with a sample (without replacement) of the pairs held
+            self._subsample_expected_distances = True
+            self._distance_matrix_fill = 0.0
+        if self._subsample_expected_distances and not self._replace_expected_distances:
+            self._update_expected_sample_without_replacement(n_pairs, n_old_pairs, n_old, rng, pool)
+            return
+        if self._subsample_expected_distances:
+            n_new_pairs = n_pairs - n_old_pairs
+            replaced = np.flatnonzero(rng.random(len(self.expected_distances)) < (n_new_pairs / n_pairs if n_pairs else 0))
+            replaced_ij = sample_new_different_item_pairs(self.items, n_old, len(replaced), random_state=rng)
+            nsample = self._get_n_expected_distances(n_pairs)
+            added_ij = sample_different_item_pairs(self.items, max(0, nsample - len(self.expected_distances)), random_state=rng)
+            changed_ij = tuple(np.concatenate([a, b]).astype(np.int64) for a, b in zip(replaced_ij, added_ij))
+        else:
+            replaced = np.empty(0, dtype=np.int64)
+            changed_ij = get_new_different_item_pairs(self.items, n_old)
+        if self.verbose: print("Calculating different-item distances")
+        changed_distances = get_pair_distances(self.all_labels, self.distance_fn, changed_ij, pool, self.distance_cache)
+        expected_ij = tuple(np.array(ij, dtype=np.int64) for ij in self.expected_ij)
+        expected_distances = np.array(self.expected_distances, dtype=float)
+        for ij, changed in zip(expected_ij, changed_ij):
+            ij[replaced] = changed[:len(replaced)]
+        expected_distances[replaced] = changed_distances[:len(replaced)]
+        self.expected_ij = tuple(np.concatenate([ij, changed[len(replaced):]]) for ij, changed in zip(expected_ij, changed_ij))
+        self.expected_distances = np.concatenate([expected_distances, changed_distances[len(replaced):]])
+        self.items_of_expected_distances = get_pair_sets(self.items, self.expected_ij)
+
+    def _update_expected_sample_without_replacement(self, n_pairs, n_old_pairs, n_old, rng, pool):
+        """
+        Update a sample of between-item pairs drawn without replacement to a uniform sample of all pairs
+
+        The number of new pairs in the updated sample is that of a sample (without replacement) of all
+        pairs, and the remaining pairs are a random subset of the (uniformly sampled) old pairs held.
+        """
+        nsample = self._get_n_expected_distances(n_pairs)
+        n_new = int(np.sum(_choice_without_replacement(rng, n_pairs, nsample) >= n_old_pairs))
+        n_held = len(self.expected_distances)
+        kept = np.sort(rng.permutation(n_held)[:min(nsample - n_new, n_held)])
+        new_ij = sample_new_different_item_pairs(self.items, n_old, n_new, replace=False, random_state=rng)
+        if self.verbose: print("Calculating different-item distances")
+        new_distances = get_pair_distances(self.all_labels, self.distance_fn, new_ij, pool, self.distance_cache)
+        self.expected_ij = tuple(np.concatenate([np.asarray(ij, dtype=np.int64)[kept], new]) for ij, new in zip(self.expected_ij, new_ij))
+        self.expected_distances = np.concatenate([np.asarray(self.expected_distances, dtype=float)[kept], new_distances])
+        self.items_of_expected_distances = get_pair_sets(self.items, self.expected_ij)
     
     def plot_matrix(self, labels=None, figsize=8, title=None, show_grid=False):
         fix, ax = plt.subplots(figsize=(figsize, figsize))
         if labels is not None:
             for i, label in enumerate(self.all_labels):
                 plt.annotate(label, (i, 0.15 + i), color="k")
-        plt.imshow(self.distance_matrix, vmin=-0.1, vmax=1.5, cmap="plasma")
+        distance_matrix = self.distance_matrix
+        plt.imshow(distance_matrix, vmin=-0.1, vmax=1.5, cmap="plasma")
         ax = plt.gca()
         if show_grid:
-            minor_grids = np.arange(-.5, self.distance_matrix.shape[0], 1)
+            minor_grids = np.arange(-.5, distance_matrix.shape[0], 1)
             ax.set_xticks(minor_grids, minor=True)
             ax.set_yticks(minor_grids, minor=True)
             ax.grid(which='minor', color='w', linestyle='-', linewidth=1)
@@ -194,30 +824,239 @@ def split_items_by_gold_error(iaa, items_per_split=4):
     return split_items
 
 def split_iaa_by_item(iaa, split_items):
+    """
+    Split an agreement object into one object per (disjoint) list of items
+
+    Each split gets the parent's observed distances between annotations of its items, sliced
+    from the parent's stored pairs in a single pass (no distances are recomputed), and the
+    parent's expected distances as reference distribution.
+    """
+    # assign annotations to splits (0: in no split)
+    split_of_item = {item: s + 1 for s, items in enumerate(split_items) for item in items}
+    split_of_row = np.array([split_of_item.get(item, 0) for item in iaa.items], dtype=np.int64)
+    row_order = np.argsort(split_of_row, kind="stable")
+    row_bounds = np.concatenate([[0], np.cumsum(np.bincount(split_of_row, minlength=len(split_items) + 1))])
+    position = np.empty(len(split_of_row), dtype=np.int64)
+
+    observed_i, observed_j = iaa.observed_ij
+    split_of_pair = split_of_row[observed_i]
+    pair_order = np.argsort(split_of_pair, kind="stable")
+    pair_bounds = np.concatenate([[0], np.cumsum(np.bincount(split_of_pair, minlength=len(split_items) + 1))])
+
     mini_iaas = []
-    for items in split_items:
-        mini_df = iaa.annodf[iaa.annodf["item"].isin(items)]
-        mini_iaa = InterAnnotatorAgreement(mini_df, "item", "worker", "label", iaa.distance_fn, verbose=iaa.verbose)
-        mini_iaa.setup(parallel_calc=False, precomputed_observed_distances=iaa.expected_distances)
+    for s in range(1, len(split_items) + 1):
+        rows = row_order[row_bounds[s]:row_bounds[s + 1]]
+        pairs = pair_order[pair_bounds[s]:pair_bounds[s + 1]]
+        mini_df = iaa.annodf.iloc[rows]
+        # track where the annotations end up when the new object sorts them
+        mini_iaa = InterAnnotatorAgreement(mini_df.set_axis(np.arange(len(rows))), "item", "worker", "label", iaa.distance_fn, verbose=iaa.verbose)
+        sorted_rows = mini_iaa.annodf.index.values
+        mini_iaa.annodf.index = mini_df.index[sorted_rows]
+        position[rows[sorted_rows]] = np.arange(len(rows))
+
+        # map the parent's pairs to (i, j) pairs with i > j in the split, in the order `setup` would produce
+        pair_i, pair_j = position[observed_i[pairs]], position[observed_j[pairs]]
+        swap = pair_i < pair_j
+        pair_i, pair_j = np.where(swap, pair_j, pair_i), np.where(swap, pair_i, pair_j)
+        idx = np.lexsort((pair_j, pair_i))
+        pairs, swap = pairs[idx], swap[idx]
+        mini_iaa.observed_ij = (pair_i[idx], pair_j[idx])
+        mini_iaa.observed_distances = iaa.observed_distances[pairs]
+        mini_iaa.items_of_distances = iaa.items_of_distances[pairs]
+        mini_iaa.workers_of_distances = np.where(swap[:, None], iaa.workers_of_distances[pairs][:, ::-1], iaa.workers_of_distances[pairs])
+        mini_iaa.expected_distances = iaa.expected_distances
         mini_iaas.append(mini_iaa)
     return mini_iaas
 
 # own
 from itertools import chain
 
-se_to_range = lambda a: set(range(a[0], a[1]))
+def merge_spans(spans):
+    """Merge (start, end, ...) spans into a sorted list of disjoint [start, end) intervals, dropping empty spans"""
+    merged = []
+    for start, end in sorted((span[0], span[1]) for span in spans if span[1] > span[0]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def _intersection_length(spans1, spans2):
+    """Total length of the intersection of two merged interval lists (by sweeping both)"""
+    i, j, total = 0, 0, 0
+    while i < len(spans1) and j < len(spans2):
+        overlap = min(spans1[i][1], spans2[j][1]) - max(spans1[i][0], spans2[j][0])
+        if overlap > 0:
+            total += overlap
+        if spans1[i][1] < spans2[j][1]:
+            i += 1
+        else:
+            j += 1
+    return total
+
 def overlap_distance(ann1, ann2):
+    """Jaccard distance between the character positions covered by two lists of (start, end) spans"""
     if len(ann1) == 0 and len(ann2) == 0:
         return 0.0
     if len(ann1) == 0 or len(ann2) == 0:
         return 1.0
-    set1 = set(chain.from_iterable(map(se_to_range, ann1)))
-    set2 = set(chain.from_iterable(map(se_to_range, ann2)))
-    intersection = set1 & set2
+    spans1, spans2 = merge_spans(ann1), merge_spans(ann2)
+    intersection = _intersection_length(spans1, spans2)
     # if no overlap, return 1.0
     if not intersection:
         return 1.0
     # jaccard distance
     # Jaccard distance = 1 - (size of intersection / size of union)
-    union = set1 | set2
-    return 1.0 - len(intersection) / len(union)
+    union = sum(end - start for start, end in spans1) + sum(end - start for start, end in spans2) - intersection
+    return 1.0 - intersection / union
+
+def normalize_spans(all_labels):
+    """
+    Merge the spans of each label and pack them into one array for `overlap_distance_batched`
+
+    Returns `(spans, offsets, is_empty)`, where `spans[offsets[k]:offsets[k+1]]` are the merged
+    [start, end) intervals of label k and `is_empty[k]` flags labels without any span.
+    """
+    merged = [merge_spans(label) for label in all_labels]
+    offsets = np.concatenate([[0], np.cumsum([len(m) for m in merged])]).astype(np.int64)
+    spans = np.array(flatten(merged), dtype=np.int64).reshape(-1, 2)
+    is_empty = np.array([len(label) == 0 for label in all_labels], dtype=bool)
+    return spans, offsets, is_empty
+
+def overlap_distance_batched(normalized_spans, label_ij):
+    """
+    Compute `overlap_distance` for all (i, j) index pairs in `label_ij` at once
+
+    `normalized_spans` is the output of `normalize_spans(all_labels)`.
+    Since merged intervals are disjoint, the intersection of two labels is the sum of the
+    overlaps of all combinations of their intervals.
+    """
+    spans, offsets, is_empty = normalized_spans
+    rows, cols = np.asarray(label_ij[0], dtype=np.int64), np.asarray(label_ij[1], dtype=np.int64)
+    counts = np.diff(offsets)
+    cum_lengths = np.concatenate([[0], np.cumsum(spans[:, 1] - spans[:, 0])])
+    lengths = cum_lengths[offsets[1:]] - cum_lengths[offsets[:-1]]
+
+    n_a, n_b = counts[rows], counts[cols]
+    n_comb = n_a * n_b
+    pair_of = np.repeat(np.arange(len(rows)), n_comb)
+    k = np.arange(n_comb.sum()) - np.repeat(np.cumsum(n_comb) - n_comb, n_comb)
+    ia = offsets[rows][pair_of] + k // n_b[pair_of]
+    ib = offsets[cols][pair_of] + k % n_b[pair_of]
+    overlap = np.minimum(spans[ia, 1], spans[ib, 1]) - np.maximum(spans[ia, 0], spans[ib, 0])
+    intersection = np.bincount(pair_of, weights=np.clip(overlap, 0, None), minlength=len(rows))
+
+    union = lengths[rows] + lengths[cols] - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.where(intersection > 0, 1.0 - intersection / union, 1.0)
+    result[is_empty[rows] & is_empty[cols]] = 0.0
+    return result
+
+
+class BatchedDistance(abc.ABC):
+    """
+    Base class of distances computed for arrays of pairs at once
+
+    Subclasses implement `prepare`, which converts the label array into the representation
+    `compute` works on, and `compute`, which returns the distances of the (i, j) index pairs
+    as a vector. The prepared representation of the last label array passed to `pairwise` is
+    memoized, so repeated calls on the same array (observed and expected distances, chunks)
+    prepare it only once. Instances can be passed as `distance_fn` to `InterAnnotatorAgreement`
+    and still work as scalar functions `distance(label_a, label_b)`.
+    """
+    _prepared_labels = None
+    _prepared = None
+
+    def prepare(self, all_labels):
+        return all_labels
+
+    @abc.abstractmethod
+    def compute(self, prepared, rows, cols):
+        """Return the distances of the (rows[k], cols[k]) index pairs into the prepared label array"""
+
+    def _get_prepared(self, all_labels):
+        if self._prepared_labels is not all_labels:
+            self._prepared = self.prepare(all_labels)
+            self._prepared_labels = all_labels
+        return self._prepared
+
+    def pairwise(self, all_labels, label_ij):
+        rows, cols = np.asarray(label_ij[0], dtype=np.int64), np.asarray(label_ij[1], dtype=np.int64)
+        if len(rows) == 0:
+            return np.empty(0)
+        return np.asarray(self.compute(self._get_prepared(all_labels), rows, cols), dtype=float)
+
+    def __call__(self, label_a, label_b):
+        labels = np.empty(2, dtype=object)
+        labels[0], labels[1] = label_a, label_b
+        # bypass the memo so that it keeps the prepared label array of `pairwise`
+        return float(np.asarray(self.compute(self.prepare(labels), np.array([0]), np.array([1])), dtype=float)[0])
+
+    def __getstate__(self):
+        # the memoized label array is not shipped to worker processes
+        state = dict(self.__dict__)
+        state.pop("_prepared_labels", None)
+        state.pop("_prepared", None)
+        return state
+
+class ScalarDistance(BatchedDistance):
+    """Adapter of a scalar function `dist_fn(label_a, label_b)` to the batched protocol (one Python call per pair)"""
+    def __init__(self, dist_fn):
+        self.dist_fn = dist_fn
+
+    def compute(self, prepared, rows, cols):
+        return _pair_distances(prepared, self.dist_fn, rows, cols)
+
+    def __call__(self, label_a, label_b):
+        return self.dist_fn(label_a, label_b)
+
+class NominalDistance(BatchedDistance):
+    """0 for identical labels, 1 otherwise (labels are compared as canonical hashable keys)"""
+    def prepare(self, all_labels):
+        codes = {}
+        return np.array([codes.setdefault(_hashable(label), len(codes)) for label in all_labels], dtype=np.int64)
+
+    def compute(self, prepared, rows, cols):
+        return (prepared[rows] != prepared[cols]).astype(float)
+
+class IntervalDistance(BatchedDistance):
+    """Krippendorff's interval metric (a - b)**2 of numeric labels"""
+    def prepare(self, all_labels):
+        return np.asarray(all_labels, dtype=float)
+
+    def compute(self, prepared, rows, cols):
+        return (prepared[rows] - prepared[cols])**2
+
+class RatioDistance(IntervalDistance):
+    """Krippendorff's ratio metric ((a - b) / (a + b))**2 of non-negative numeric labels (0 if both are 0)"""
+    def compute(self, prepared, rows, cols):
+        a, b = prepared[rows], prepared[cols]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(a + b == 0, 0.0, ((a - b) / (a + b))**2)
+
+class CosineDistance(BatchedDistance):
+    """1 - cosine similarity of embedding labels (NaN for zero vectors), computed in chunks of about `chunk_size` entries"""
+    def __init__(self, chunk_size=10_000_000):
+        self.chunk_size = chunk_size
+
+    def prepare(self, all_labels):
+        embeddings = np.stack([np.asarray(label, dtype=float).ravel() for label in all_labels])
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return embeddings / norms
+
+    def compute(self, prepared, rows, cols):
+        result = np.empty(len(rows))
+        step = max(1, self.chunk_size // max(1, prepared.shape[1]))
+        for start in range(0, len(rows), step):
+            a, b = prepared[rows[start:start + step]], prepared[cols[start:start + step]]
+            result[start:start + step] = 1.0 - np.einsum("ij,ij->i", a, b)
+        return result
+
+class OverlapDistance(BatchedDistance):
+    """Batched `overlap_distance` of span annotations (see `overlap_distance_batched`)"""
+    def prepare(self, all_labels):
+        return normalize_spans(all_labels)
+
+    def compute(self, prepared, rows, cols):
+        return overlap_distance_batched(prepared, (rows, cols))
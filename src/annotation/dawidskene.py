@@ -1,10 +1,25 @@
+import json
+import time
 import numpy as np
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor as Pool
+from scipy.sparse import csr_matrix, issparse
+from scipy.optimize import linear_sum_assignment
 
 from dataclasses import dataclass
 
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Dict, Hashable, Callable
+
+from src.utils.parallel import worker_state, map_with_shared_state
+
+# number of stored counts from which on float32 is used by default (see `DawidSkeneModel.dtype`)
+FLOAT32_MIN_SIZE = 10_000_000
+
+def _logsumexp(a, axis):
+    # numerically stable log(sum(exp(a))) (lighter than scipy.special.logsumexp, which matters in the EM loop)
+    a_max = a.max(axis=axis, keepdims=True)
+    a_max[~np.isfinite(a_max)] = 0
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(a - a_max).sum(axis=axis, keepdims=True)) + a_max
 
 @dataclass
 class DawidSkeneModelOutput:
@@ -21,16 +36,46 @@ class DawidSkeneModelOutput:
         posterior item label class probabilities
     worker_reliabilities: dict
         workers' reliability scores computed as the diagonal of the posterior abilitiy estimates matrix
+    restarts: list
+        diagnostics of the EM restarts (only if fitted with `n_restarts > 1`), one dict per restart
+        with the restart's seed, final log-likelihood, number of iterations, and whether it was selected
+    trace: pd.DataFrame
+        EM iteration trace, one row per iteration with the log-likelihood, the marginal and error rate
+        changes compared to the previous iteration (the quantities checked by the stopping rule),
+        wall time spent in the M-step, E-step and log-likelihood computation (in seconds), and
+        the bytes held by the count tensor plus the arrays allocated by the iteration's largest M- or E-step (an estimate of peak tensor memory)
 
     """
     pi: np.ndarray
     theta: np.ndarray
     z: np.ndarray
     worker_reliabilities: dict
+    restarts: Optional[List[dict]] = None
+    trace: Optional[pd.DataFrame] = None
 
     def __repr__(self):
         return f"DawidSkeneModelOutput(pi={self.pi}, theta={self.theta}, z={self.z}, worker_reliabilities={self.worker_reliabilities})"
 
+@dataclass
+class DawidSkeneBootstrapOutput:
+    """
+    Bootstrap confidence intervals of fitted Dawid-Skene model estimates
+
+    Attributes:
+    worker_reliabilities: pd.DataFrame (n_workers, 3)
+        workers' reliability point estimates and lower and upper confidence bounds (indexed by annotator ID)
+    pi: pd.DataFrame (n_classes, 3)
+        label class prevalence point estimates and lower and upper confidence bounds (indexed by label)
+    reliability_samples: np.ndarray (n_bootstrap, n_workers)
+        workers' reliabilities in each bootstrap replicate (NaN if a worker has no annotations in a replicate)
+    pi_samples: np.ndarray (n_bootstrap, n_classes)
+        label class prevalence in each bootstrap replicate
+    """
+    worker_reliabilities: pd.DataFrame
+    pi: pd.DataFrame
+    reliability_samples: np.ndarray
+    pi_samples: np.ndarray
+
 class DawidSkeneModel:
     """
     Dawid-Skene model for categorical annotation aggregation.
@@ -40,6 +85,12 @@ class DawidSkeneModel:
     Attributes:
     n_classes: int
         Number of classes
+    sparse: bool
+        Whether annotations are stored as sparse (item, annotator, label) counts instead of a dense tensor
+    n_restarts: int
+        Number of EM runs from different initialisations
+    acceleration: str
+        EM acceleration scheme (None or 'squarem')
 
     Methods:
     """
@@ -48,7 +99,14 @@ class DawidSkeneModel:
         n_classes: int,
         max_iter: int = 100,
         tolerance: float = 0.01,
-        verbose: bool = True
+        verbose: bool = True,
+        sparse: bool = False,
+        n_restarts: int = 1,
+        n_jobs: Optional[int] = None,
+        random_state: Optional[int] = None,
+        acceleration: Optional[str] = None,
+        callback: Optional[Callable[[dict], None]] = None,
+        dtype: Optional[Union[str, np.dtype]] = None
     ) -> None:
         """
         Initialize Dawid-Skene model
@@ -59,44 +117,162 @@ class DawidSkeneModel:
         max_iter: int
 
         tolerance: float
+
+        verbose: bool
+            Whether to print the log-likelihood during fitting
+        sparse: bool
+            If True, keep the annotations as sparse (item, annotator, label) triples in a CSR matrix
+            of shape (n_items, n_annotators*n_classes) so that memory grows with the number of
+            annotations rather than with n_items x n_annotators x n_classes.
+            Recommended for large crowds where each annotator labels only few items.
+        n_restarts: int
+            Number of EM runs. The first run starts from the default initialisation, the others
+            from randomly perturbed initialisations. The latent classes of the perturbed runs are aligned to
+            those of the first run (which may converge to a label-permuted solution with the same likelihood),
+            and the run with the highest final log-likelihood is kept.
+        n_jobs: int
+            Number of worker processes to distribute restarts across (None or 1: run sequentially, -1: use all CPU cores)
+        random_state: int
+            Seed for the perturbed initialisations
+        acceleration: str
+            If 'squarem', accelerate EM with the SQUAREM scheme (Varadhan & Roland, 2008):
+            each iteration takes two EM steps, extrapolates the item posteriors along the
+            direction they moved in, and takes a stabilizing EM step from the extrapolated point.
+            If the extrapolation decreases the log-likelihood compared to the plain EM steps,
+            the plain EM update is used instead.
+            Reduces the number of iterations when plain EM converges slowly (e.g., with weak annotators).
+            Note that an iteration then takes three M- and E-steps.
+        callback: Callable
+            Function called after every EM iteration with the iteration's trace record (see `DawidSkeneModelOutput.trace`),
+            e.g., for logging or monitoring. Not called in restarts, bootstrap replicates or batched fitting.
+        dtype: str or np.dtype
+            Floating point precision of the count tensor, posteriors and error rates ('float32' or 'float64').
+            If None, float32 is used when the count tensor (or, if `sparse`, the number of annotations)
+            has at least `FLOAT32_MIN_SIZE` entries, and float64 otherwise.
+            All computations are in the log domain, so float32 halves memory and bandwidth without underflow.
         """
         assert n_classes > 1, "Number of classes must be greater than 1"
         assert max_iter > 0, "max_iter must be greater than 0"
         assert tolerance > 0, "tolerance must be greater than 0"
+        assert n_restarts > 0, "n_restarts must be greater than 0"
+        assert acceleration in (None, 'squarem'), "acceleration must be None or 'squarem'"
+        assert dtype is None or np.dtype(dtype) in (np.float32, np.float64), "dtype must be None, 'float32' or 'float64'"
 
         self.n_classes = n_classes
         self.max_iter = max_iter
         self.tolerance = tolerance
         self.verbose = verbose
+        self.sparse = sparse
+        self.n_restarts = n_restarts
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.acceleration = acceleration
+        self.callback = callback
+        self.dtype = dtype
+        # per-iteration timings and allocated bytes (see `_track`)
+        self._timings = None
     
     def __repr__(self):
-        return f"DawidSkeneModel(n_classes={self.n_classes}, max_iter={self.max_iter}, tolerance={self.tolerance})"
+        return f"DawidSkeneModel(n_classes={self.n_classes}, max_iter={self.max_iter}, tolerance={self.tolerance}, sparse={self.sparse})"
 
     @staticmethod
-    def _list2array(class_num, dataset_list):
-        task_num, worker_num, class_num = len(dataset_list), len(dataset_list[0]), class_num
-        dataset_tensor = np.zeros((task_num, worker_num, class_num))
-
-        for task_i in range(task_num): 
-            for worker_j in range(worker_num): 
-                if isinstance(dataset_list[task_i][worker_j], list):
-                    for predict_label_k in dataset_list[task_i][worker_j]:
-                        dataset_tensor[task_i][worker_j][predict_label_k] += 1
-                elif dataset_list[task_i][worker_j] is None or np.isnan(dataset_list[task_i][worker_j]):
-                    continue
-                else:
-                    predict_label = int(dataset_list[task_i][worker_j])
-                    dataset_tensor[task_i][worker_j][predict_label] += 1
-
-        return dataset_tensor
-    
-    def _run(self, dataset, gold: Optional[np.ndarray]=None):
-        self.task_num, self.worker_num, _ = dataset.shape
-        self.dataset_tensor = dataset
+    def _encode(values: pd.Series, categories=None):
+        """
+        Integer-encode values in order of first appearance, or against known `categories` (unseen values get code -1)
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]
+            codes and categories (missing values get code -1 and are not included in categories)
+        """
+        if categories is None:
+            codes, categories = pd.factorize(values, use_na_sentinel=True)
+            return codes, np.asarray(categories)
+        return pd.Categorical(values, categories=categories).codes.astype(np.int64), categories
+
+    @staticmethod
+    def _encode_extend(values: pd.Series, categories):
+        """Integer-encode values against known `categories`, appending unseen (non-missing) values as new categories"""
+        codes, _ = DawidSkeneModel._encode(values, categories)
+        new_categories = pd.unique(values[(codes < 0) & values.notna().to_numpy()])
+        if len(new_categories) > 0:
+            categories = np.concatenate([np.asarray(categories), np.asarray(new_categories)])
+            codes, _ = DawidSkeneModel._encode(values, categories)
+        return codes, categories
+
+    @staticmethod
+    def _explode(df: pd.DataFrame, annotations_col: str):
+        """Expand multi-label cells (list-like values in `annotations_col`) into one row per label"""
+        if df[annotations_col].dtype == object:
+            df = df.explode(annotations_col)
+        return df
+
+    def _get_dtype(self, size):
+        if self.dtype is not None:
+            return np.dtype(self.dtype)
+        return np.dtype(np.float32) if size >= FLOAT32_MIN_SIZE else np.dtype(np.float64)
+
+    def _build_dataset(self, tasks, workers, labels, task_num, worker_num):
+        """Scatter-add (item, worker, label) index triples into a count tensor (or sparse count matrix), skipping negative codes"""
+        keep = (tasks >= 0) & (workers >= 0) & (labels >= 0)
+        tasks, workers, labels = tasks[keep], workers[keep], labels[keep]
+        if self.sparse:
+            return DawidSkeneModel._triples2sparse(self.n_classes, task_num, worker_num, tasks, workers, labels, counts=np.ones(len(tasks), dtype=self.dtype_))
+        # duplicate annotations are counted repeatedly
+        flat_idxs = (tasks*worker_num + workers)*self.n_classes + labels
+        dataset = np.bincount(flat_idxs, minlength=task_num*worker_num*self.n_classes).astype(self.dtype_)
+        return dataset.reshape(task_num, worker_num, self.n_classes)
+
+    @staticmethod
+    def _triples2sparse(class_num, task_num, worker_num, tasks, workers, labels, counts=None):
+        """Build (n_items, n_workers*n_classes) CSR count matrix from (item, worker, label) index triples"""
+        if counts is None:
+            counts = np.ones(len(tasks))
+        # duplicate triples are summed when converting to CSR
+        return csr_matrix(
+            (counts, (np.asarray(tasks), np.asarray(workers)*class_num + np.asarray(labels))),
+            shape=(task_num, worker_num*class_num)
+        )
+
+    def _get_item_class_counts(self):
+        """(n_items, n_classes) number of times each item has been assigned each class (summed over workers)"""
+        if issparse(self._counts):
+            coo = self._counts.tocoo()
+            idxs = coo.row*self.n_classes + coo.col % self.n_classes
+            return np.bincount(idxs, weights=coo.data, minlength=self.task_num*self.n_classes).reshape(self.task_num, self.n_classes)
+        return self._counts.reshape(self.task_num, self.worker_num, self.n_classes).sum(1)
+
+    def _set_dataset(self, dataset):
+        if issparse(dataset):
+            # sparse (n_items, n_workers*n_classes) count matrix
+            self.task_num, self.worker_num = dataset.shape[0], dataset.shape[1] // self.n_classes
+            self.dataset_tensor = None
+            self._counts = dataset.tocsr()
+        else:
+            self.task_num, self.worker_num, _ = dataset.shape
+            self.dataset_tensor = dataset
+            # flat (n_items, n_workers*n_classes) view of the count tensor used by the batched M- and E-step
+            self._counts = dataset.reshape(self.task_num, -1)
+
+    def _get_default_init(self):
+        predict_label = np.ones((self.task_num, self.n_classes)) + self._get_item_class_counts()*0.01
+        predict_label /= predict_label.sum(1).reshape(-1, 1)
+        return predict_label.astype(self._counts.dtype)
+
+    def _get_perturbed_init(self, seed):
+        # mix default initialisation with random item label class probabilities
+        rng = np.random.default_rng(seed)
+        predict_label = 0.5*self._get_default_init() + 0.5*rng.dirichlet(np.ones(self.n_classes), size=self.task_num)
+        return predict_label.astype(self._counts.dtype)
+
+    def _run(self, dataset, gold: Optional[np.ndarray]=None, init: Optional[np.ndarray]=None, max_iter: Optional[int]=None):
+        self._set_dataset(dataset)
         
         # init posterior label class probabilities
-        predict_label = np.ones((self.task_num, self.n_classes)) + self.dataset_tensor.sum(1)*0.01
-        predict_label /= predict_label.sum(1).reshape(-1, 1)
+        if init is not None:
+            # warm start
+            predict_label = init.astype(self._counts.dtype)
+        else:
+            predict_label = self._get_default_init()
         if gold is not None:
             idxs = ~np.logical_or(np.isnan(gold), gold==-1)
             predict_label[idxs,:] = np.eye(self.n_classes)[gold[idxs].astype(int)]
@@ -104,12 +280,18 @@ class DawidSkeneModel:
         flag = True
         prev_error_rates, prev_predict_label = None, None
         self.iter_num = 0
+        self.trace_ = []
 
         while flag:
-            error_rates = self._m_step(predict_label)
-            next_predict_label = self._e_step(predict_label, error_rates)
-            log_L = self._get_likelihood(predict_label, error_rates)
+            self._timings = {'m_step': 0.0, 'e_step': 0.0, 'likelihood': 0.0, 'step_bytes': 0}
+            t0 = time.perf_counter()
+            if self.acceleration == 'squarem':
+                predict_label, error_rates, next_predict_label, log_L = self._squarem_step(predict_label)
+            else:
+                error_rates = self._m_step(predict_label)
+                next_predict_label, log_L = self._e_step_and_likelihood(predict_label, error_rates)
 
+            marginals_diff, error_rates_diff = np.nan, np.nan
             if self.iter_num == 0:
                 if self.verbose:
                     # logging.info("{}\t{}".format(self.iter_num, log_L))
@@ -123,9 +305,24 @@ class DawidSkeneModel:
                 marginals_diff = np.sum(np.abs(marginal_predict - prev_marginal_predict))
                 error_rates_diff = np.sum(np.abs(error_rates - prev_error_rates))
 
-                if self._check_condition(marginals_diff, error_rates_diff, self.iter_num):
+                if self._check_condition(marginals_diff, error_rates_diff, self.iter_num, max_iter=max_iter):
                     flag = False
 
+            record = {
+                'iter': self.iter_num,
+                'log_likelihood': log_L,
+                'marginals_diff': marginals_diff,
+                'error_rates_diff': error_rates_diff,
+                'time_m_step': self._timings['m_step'],
+                'time_e_step': self._timings['e_step'],
+                'time_likelihood': self._timings['likelihood'],
+                'time_total': time.perf_counter() - t0,
+                'tensor_bytes': DawidSkeneModel._nbytes(self._counts) + self._timings['step_bytes'],
+            }
+            self.trace_.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
             prev_error_rates = error_rates
             prev_predict_label = predict_label
             # NOTE: if you want to hard-code gold examples labels, uncomment the following two lines:
@@ -134,54 +331,117 @@ class DawidSkeneModel:
             predict_label = next_predict_label
             self.iter_num += 1
 
-        worker_reliability = {}
-        for i in range(self.worker_num):
-            ie_rates = marginal_predict * error_rates[i, :, :]
-            reliability = np.sum(np.diag(ie_rates))
-            worker_reliability[i] = reliability
+        self.log_likelihood_ = log_L
+        self._timings = None
+
+        worker_reliability = dict(enumerate(self._get_worker_reliabilities(marginal_predict, error_rates)))
             
         return marginal_predict, error_rates, worker_reliability, predict_label
 
-    def _check_condition(self, marginals_diff, error_rates_diff, iter_num):
-        return (marginals_diff < self.tolerance and error_rates_diff < self.tolerance) or iter_num > self.max_iter
+    def _squarem_step(self, predict_label):
+        """
+        One SQUAREM iteration on the item posteriors (with likelihood safeguard)
+
+        Returns:
+        Tuple
+            posteriors the returned error rates were estimated from, error rates,
+            next posteriors, and log-likelihood of the error rates
+        """
+        # two plain EM steps
+        error_rates_0 = self._m_step(predict_label)
+        predict_label_1, _ = self._e_step_and_likelihood(predict_label, error_rates_0)
+        error_rates_1 = self._m_step(predict_label_1)
+        predict_label_2, log_L_1 = self._e_step_and_likelihood(predict_label_1, error_rates_1)
+
+        # extrapolate (step length as in SqS3)
+        r = predict_label_1 - predict_label
+        v = predict_label_2 - predict_label_1 - r
+        v_norm = np.sqrt(np.sum(v**2))
+        alpha = -np.sqrt(np.sum(r**2)) / v_norm if v_norm > 0 else -1.0
+        alpha = min(alpha, -1.0)
+        if alpha == -1.0:
+            # extrapolation coincides with the second EM step
+            return predict_label_1, error_rates_1, predict_label_2, log_L_1
+        extrapolated = predict_label - 2*alpha*r + alpha**2*v
+        # project back onto the probability simplex
+        extrapolated = np.maximum(extrapolated, 0.0)
+        extrapolated /= extrapolated.sum(1, keepdims=True)
+
+        # stabilizing EM step
+        error_rates = self._m_step(extrapolated)
+        next_predict_label, log_L = self._e_step_and_likelihood(extrapolated, error_rates)
+        if not log_L >= log_L_1:
+            # safeguard: fall back to plain EM if extrapolating decreases the likelihood
+            return predict_label_1, error_rates_1, predict_label_2, log_L_1
+        return extrapolated, error_rates, next_predict_label, log_L
+
+    @staticmethod
+    def _get_worker_reliabilities(marginal_predict, error_rates):
+        # diagonal of the workers' error rates weighted by class prevalence
+        return np.einsum('j,wjj->w', marginal_predict, error_rates)
+
+    def _check_condition(self, marginals_diff, error_rates_diff, iter_num, max_iter=None):
+        max_iter = self.max_iter if max_iter is None else max_iter
+        return (marginals_diff < self.tolerance and error_rates_diff < self.tolerance) or iter_num > max_iter
+
+    @staticmethod
+    def _nbytes(array):
+        if issparse(array):
+            return array.data.nbytes + array.indices.nbytes + array.indptr.nbytes
+        return array.nbytes
+
+    def _track(self, key, t0, *arrays):
+        """Add time since `t0` to the current iteration's trace record and keep the maximum bytes of `arrays` allocated by one step (if tracing)"""
+        if self._timings is not None:
+            self._timings[key] += time.perf_counter() - t0
+            # steps run one after the other (also in SQUAREM), so their allocations are not held at the same time
+            self._timings['step_bytes'] = max(self._timings['step_bytes'], sum(a.nbytes for a in arrays))
 
     def _m_step(self, predict_label):
-        error_rates = np.zeros((self.worker_num, self.n_classes, self.n_classes))
-
-        # Equation 2.3
-        for i in range(self.n_classes):
-            worker_error_rate = np.dot(predict_label[:, i], self.dataset_tensor.transpose(1, 0 ,2))
-            sum_worker_error_rate = worker_error_rate.sum(1)
-            sum_worker_error_rate = np.where(sum_worker_error_rate == 0 , -10e9, sum_worker_error_rate)
-            error_rates[:, i, :] = worker_error_rate / sum_worker_error_rate.reshape(-1,1)                                                                        
+        t0 = time.perf_counter()
+        # Equation 2.3, for all classes at once: (n_classes, n_items) x (n_items, n_workers*n_classes)
+        #  (with sparse counts, this is a segment sum over the annotations of each worker and label)
+        worker_error_rate = np.asarray(predict_label.T @ self._counts).reshape(self.n_classes, self.worker_num, self.n_classes)
+        error_rates = worker_error_rate.transpose(1, 0, 2)
+        sum_worker_error_rate = error_rates.sum(2, keepdims=True)
+        # workers without (posterior-weighted) annotations of a class get all-zero error rates
+        error_rates = np.divide(error_rates, sum_worker_error_rate, out=np.zeros_like(error_rates), where=sum_worker_error_rate > 0)
+        self._track('m_step', t0, error_rates)
         return error_rates
     
+    def _get_log_class_likelihood(self, error_rates, counts=None):
+        # \sum_{k=1}^K \sum_{l=1}^J n_{il}^{(k)} \log \pi_{jl}^{(k)} for all items i and classes j at once
+        #  (error rates that are exactly zero are floored so that 0 * log(0) contributes 0)
+        #  (with sparse counts, this is a segment sum over the annotations of each item)
+        counts = self._counts if counts is None else counts
+        log_error_rates = np.log(np.maximum(error_rates, np.finfo(error_rates.dtype).tiny))
+        return np.asarray(counts @ log_error_rates.transpose(0, 2, 1).reshape(-1, self.n_classes))
+
+    def _e_step_and_likelihood(self, predict_label, error_rates):
+        """Batched E-step (Equation 2.5) and log-likelihood (Equation 2.7) sharing one pass over the count tensor"""
+        marginal_probability = (predict_label.sum(0, dtype=np.float64) / self.task_num).astype(predict_label.dtype)
+        return self._get_posterior_and_likelihood(marginal_probability, error_rates)
+
+    def _get_posterior_and_likelihood(self, marginal_probability, error_rates, counts=None):
+        t0 = time.perf_counter()
+        with np.errstate(divide='ignore'):
+            log_joint = np.log(marginal_probability) + self._get_log_class_likelihood(error_rates, counts=counts)
+        log_evidence = _logsumexp(log_joint, axis=1)
+        next_predict_label = np.exp(log_joint - log_evidence)
+        # log error rates (same size as the error rates passed in), log joint probabilities, and posteriors
+        self._track('e_step', t0, error_rates, log_joint, next_predict_label)
+        # the log-likelihood reuses the posteriors' normalizing constants
+        t0 = time.perf_counter()
+        # accumulate in double precision
+        log_L = log_evidence.sum(dtype=np.float64)
+        self._track('likelihood', t0)
+        return next_predict_label, log_L
+
     def _e_step(self, predict_label, error_rates):
-        marginal_probability = predict_label.sum(0) / self.task_num
-        next_predict_label = np.zeros([self.task_num, self.n_classes])
-    
-        # Equation 2.5
-        for i in range(self.task_num):
-            class_likelood = self._get_class_likelood(error_rates, self.dataset_tensor[i])
-            next_predict_label[i] = marginal_probability * class_likelood
-            sum_marginal_probability = next_predict_label[i].sum()
-            sum_marginal_probability = np.where(sum_marginal_probability == 0 , -10e9, sum_marginal_probability)
-            next_predict_label[i] /= sum_marginal_probability
-        return next_predict_label
+        return self._e_step_and_likelihood(predict_label, error_rates)[0]
     
     def _get_likelihood(self, predict_label, error_rates):
-        log_L = 0
-        marginal_probability = predict_label.sum(0) / self.task_num
-
-        # Equation 2.7
-        for i in range(self.task_num):
-            class_likelood = self._get_class_likelood(error_rates, self.dataset_tensor[i])
-            log_L += np.log((marginal_probability * class_likelood).sum())
-        return log_L
-
-    def _get_class_likelood(self, error_rates, task_tensor):
-        # \sum_{j=1}^J p_{j} \prod_{k=1}^K \prod_{l=1}^J\left(\pi_{j l}^{(k)}\right)^{n_{il}^{(k)}}
-        return np.power(error_rates.transpose(0, 2, 1), np.broadcast_to(task_tensor.reshape(self.worker_num, self.n_classes, 1), (self.worker_num, self.n_classes, self.n_classes))).transpose(1, 2, 0).prod(0).prod(1)
+        return self._e_step_and_likelihood(predict_label, error_rates)[1]
     
     def fit(
         self,
@@ -202,7 +462,9 @@ class DawidSkeneModel:
         annotators_col: str
             Name of column containing the annotator IDs
         annotations_col: str
-            Name of column containing the annotation labels
+            Name of column containing the annotation labels.
+            Cells may hold lists of labels (multi-label annotations), and an annotator may
+            annotate the same item repeatedly; every label is counted as one annotation.
 
         Returns:
         DawidSkeneModelOutput
@@ -214,30 +476,28 @@ class DawidSkeneModel:
         assert annotations_col in df.columns, f"Column '{annotations_col}' not found in DataFrame"
         assert df[items_col].nunique() > 1, "At least two items are required"
         assert df[annotators_col].nunique() > 1, "At least two annotators are required"
-        assert df[annotations_col].nunique() > 1, "At least two labels are required"
 
-        # get index mappings
+        data = DawidSkeneModel._explode(df[[items_col, annotators_col, annotations_col]], annotations_col)
+
+        # get index mappings (IDs are integer-encoded in order of first appearance)
         self.annotations_col_ = annotations_col
-        self.classes_ = df[annotations_col].unique()
+        labels, self.classes_ = DawidSkeneModel._encode(data[annotations_col])
+        assert len(self.classes_) > 1, "At least two labels are required"
+        assert len(self.classes_) <= self.n_classes, f"Found {len(self.classes_)} distinct labels but n_classes={self.n_classes}"
         self.annotation_id2idx_ = {lid: idx for idx, lid in enumerate(self.classes_)}
         
         self.items_col_ = items_col
-        self.n_items = df[items_col].nunique()
-        self.items_ = df[items_col].unique()
+        items, self.items_ = DawidSkeneModel._encode(data[items_col])
+        self.n_items = len(self.items_)
         self.item_id2idx_ = {pid: idx for idx, pid in enumerate(self.items_)}
         
         self.annotators_col_ = annotators_col
-        self.n_annotators = df[annotators_col].nunique()
-        self.annotators_ = df[annotators_col].unique()
+        annotators, self.annotators_ = DawidSkeneModel._encode(data[annotators_col])
+        self.n_annotators = len(self.annotators_)
         self.annotator_id2idx_ = {cid: idx for idx, cid in enumerate(self.annotators_)}
         
-        dataset = pd.DataFrame({
-            'item': df[items_col].map(self.item_id2idx_),
-            'annotator': df[annotators_col].map(self.annotator_id2idx_),
-            'annotation': df[annotations_col].map(self.annotation_id2idx_),
-        })
-        dataset = dataset.pivot(index='item', columns='annotator', values='annotation').to_numpy().tolist()
-        dataset = DawidSkeneModel._list2array(self.n_classes, dataset)
+        self.dtype_ = self._get_dtype((labels >= 0).sum() if self.sparse else self.n_items*self.n_annotators*self.n_classes)
+        dataset = self._build_dataset(items, annotators, labels, self.n_items, self.n_annotators)
 
         if gold is not None:
             if isinstance(gold, pd.Series):
@@ -245,13 +505,181 @@ class DawidSkeneModel:
             elif isinstance(gold, (list, np.ndarray)):
                 gold = np.array([g if np.isnan(g) else self.annotation_id2idx_[int(g)] for g in gold])
         
-        pi, worker_abilities, worker_reliabilities, pred_labels = self._run(dataset, gold=gold)
+        if self.n_restarts > 1:
+            pi, worker_abilities, worker_reliabilities, pred_labels, restarts = self._run_restarts(dataset, gold=gold)
+        else:
+            pi, worker_abilities, worker_reliabilities, pred_labels = self._run(dataset, gold=gold)
+            restarts = None
+
+        self.fitted_ = self._make_output(pi, worker_abilities, worker_reliabilities, pred_labels)
+        self.fitted_.restarts = restarts
+        return self.fitted_
+    
+    def _run_restarts(self, dataset, gold: Optional[np.ndarray]=None):
+        """Run EM from `n_restarts` initialisations (in parallel if `n_jobs` > 1) and keep the run with the highest log-likelihood"""
+        seeds = [None] + [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(self.random_state).spawn(self.n_restarts-1)]
+        # lightweight copy of the model for the workers
+        model = DawidSkeneModel(self.n_classes, max_iter=self.max_iter, tolerance=self.tolerance, verbose=False, sparse=self.sparse, acceleration=self.acceleration)
+        results = map_with_shared_state(_run_restart, seeds, {'model': model, 'dataset': dataset, 'gold': gold}, n_jobs=self.n_jobs)
+        # the likelihood is invariant to relabelling the latent classes, so perturbed runs may converge
+        #  to a label-permuted solution: align their classes to the default-initialized run before comparing
+        results = [results[0]] + [DawidSkeneModel._align_classes(res, results[0][3]) for res in results[1:]]
+
+        best = int(np.argmax([res[4] for res in results]))
+        restarts = [
+            {'restart': r, 'seed': seed, 'log_likelihood': res[4], 'n_iter': res[5], 'selected': r == best}
+            for r, (seed, res) in enumerate(zip(seeds, results))
+        ]
+        if self.verbose:
+            print(pd.DataFrame(restarts).to_string(index=False))
+
+        self._set_dataset(dataset)
+        self.log_likelihood_, self.iter_num, self.trace_ = results[best][4], results[best][5], results[best][6]
+        return *results[best][:4], restarts
+
+    @staticmethod
+    def _align_classes(result, reference_predict_label):
+        """Permute the latent classes of a run's estimates to best match `reference_predict_label` (Hungarian matching on posterior overlap)"""
+        pi, error_rates, _, predict_label, *rest = result
+        # expected number of items assigned to class j in the reference and class k in the run
+        _, perm = linear_sum_assignment(reference_predict_label.T @ predict_label, maximize=True)
+        pi, error_rates, predict_label = pi[perm], error_rates[:, perm, :], predict_label[:, perm]
+        worker_reliability = dict(enumerate(DawidSkeneModel._get_worker_reliabilities(pi, error_rates)))
+        return (pi, error_rates, worker_reliability, predict_label, *rest)
+
+    def bootstrap(
+        self,
+        n_bootstrap: int = 200,
+        ci: float = 0.95,
+        max_iter: Optional[int] = None,
+        n_jobs: Optional[int] = None,
+        random_state: Optional[int] = None
+    ) -> DawidSkeneBootstrapOutput:
+        """
+        Compute bootstrap confidence intervals for workers' reliabilities and label class prevalence
+
+        Each bootstrap replicate resamples items with replacement from the count tensor the model
+        has been fitted on (no re-ingestion of the annotations) and refits the model warm-started
+        from the fitted item posteriors.
+
+        Args:
+        n_bootstrap: int
+            Number of bootstrap replicates
+        ci: float
+            Confidence level of the (percentile) intervals
+        max_iter: int
+            Maximum number of EM iterations per replicate (default: `max_iter` set at initialization)
+        n_jobs: int
+            Number of worker processes to distribute replicates across (None or 1: run sequentially, -1: use all CPU cores)
+        random_state: int
+            Seed for resampling items
+
+        Returns:
+        DawidSkeneBootstrapOutput
+        """
+        assert hasattr(self, 'fitted_'), "Model must be fitted before calling bootstrap"
+        assert n_bootstrap > 0, "n_bootstrap must be greater than 0"
+        assert 0 < ci < 1, "ci must be between 0 and 1"
+
+        seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(random_state).spawn(n_bootstrap)]
+        # lightweight copy of the model for the workers
+        model = DawidSkeneModel(self.n_classes, max_iter=self.max_iter, tolerance=self.tolerance, verbose=False, sparse=self.sparse, acceleration=self.acceleration)
+        state = {'model': model, 'counts': self._counts, 'n_workers': self.worker_num, 'init': self.fitted_.z, 'max_iter': max_iter}
+        results = map_with_shared_state(_run_bootstrap_replicate, seeds, state, n_jobs=n_jobs)
+        pi_samples = np.stack([res[0] for res in results])
+        reliability_samples = np.stack([res[1] for res in results])
 
+        q = [(1-ci)/2, 1-(1-ci)/2]
+        pi = pd.DataFrame(
+            np.column_stack([self.fitted_.pi, np.quantile(pi_samples, q, axis=0).T]),
+            index=self.classes_, columns=['estimate', 'lower', 'upper']
+        )
+        reliabilities = pd.DataFrame(
+            np.column_stack([list(self.fitted_.worker_reliabilities.values()), np.nanquantile(reliability_samples, q, axis=0).T]),
+            index=list(self.fitted_.worker_reliabilities.keys()), columns=['estimate', 'lower', 'upper']
+        )
+        return DawidSkeneBootstrapOutput(reliabilities, pi, reliability_samples, pi_samples)
+
+    def _make_output(self, pi, worker_abilities, worker_reliabilities, pred_labels):
         # post-process
         annotator_idx2dx = {idx: lid for lid, idx in self.annotator_id2idx_.items()}
         worker_reliabilities = {annotator_idx2dx[i]: r for i, r in worker_reliabilities.items()}
+        trace = pd.DataFrame(self.trace_) if getattr(self, 'trace_', None) else None
+        return DawidSkeneModelOutput(pi, worker_abilities, pred_labels, worker_reliabilities, trace=trace)
+
+    def partial_fit(
+        self,
+        df: pd.DataFrame,
+        init: Optional[DawidSkeneModelOutput]=None,
+        max_iter: Optional[int]=None
+    ):
+        """
+        Update a fitted Dawid-Skene model with a new batch of annotations (warm start)
+
+        The new annotations are added to the annotations the model has been fitted on.
+        New items, annotators and labels (up to `n_classes`) are appended to the index mappings.
+        Instead of starting from a uniform initialisation, EM is initialized with the
+        posterior item label class probabilities implied by the previous estimates
+        (new annotators start from the average ability of the known annotators),
+        so typically only a few iterations are needed to reconverge.
+
+        Args:
+        df: pd.DataFrame
+            DataFrame containing the new annotations, with the same columns used in `fit`
+        init: DawidSkeneModelOutput
+            Estimates to warm-start from (default: the estimates from the latest call to `fit` or `partial_fit`)
+        max_iter: int
+            Maximum number of EM iterations (default: `max_iter` set at initialization)
+
+        Returns:
+        DawidSkeneModelOutput
+            Output of updated Dawid-Skene model
+        """
+        assert hasattr(self, 'fitted_'), "Model must be fitted before calling partial_fit"
+        if init is None:
+            init = self.fitted_
+        assert init.theta.shape == (self.n_annotators, self.n_classes, self.n_classes), "init does not match the fitted model's annotators"
+        assert len(df) > 0, "DataFrame is empty"
+        for col in [self.items_col_, self.annotators_col_, self.annotations_col_]:
+            assert col in df.columns, f"Column '{col}' not found in DataFrame"
+
+        data = DawidSkeneModel._explode(df[[self.items_col_, self.annotators_col_, self.annotations_col_]], self.annotations_col_)
+
+        # extend index mappings
+        labels, self.classes_ = DawidSkeneModel._encode_extend(data[self.annotations_col_], self.classes_)
+        assert len(self.classes_) <= self.n_classes, f"Found {len(self.classes_)} distinct labels but n_classes={self.n_classes}"
+        self.annotation_id2idx_ = {lid: idx for idx, lid in enumerate(self.classes_)}
 
-        self.fitted_ = DawidSkeneModelOutput(pi, worker_abilities, pred_labels, worker_reliabilities)
+        prev_n_items, prev_n_annotators = self.n_items, self.n_annotators
+        items, self.items_ = DawidSkeneModel._encode_extend(data[self.items_col_], self.items_)
+        self.n_items = len(self.items_)
+        self.item_id2idx_ = {pid: idx for idx, pid in enumerate(self.items_)}
+
+        annotators, self.annotators_ = DawidSkeneModel._encode_extend(data[self.annotators_col_], self.annotators_)
+        self.n_annotators = len(self.annotators_)
+        self.annotator_id2idx_ = {cid: idx for idx, cid in enumerate(self.annotators_)}
+
+        # add new annotations to the existing ones
+        dataset = self._build_dataset(items, annotators, labels, self.n_items, self.n_annotators)
+        if issparse(dataset):
+            # column index annotator*n_classes + label is unaffected by adding annotators
+            prev_dataset = self._counts.copy()
+            prev_dataset.resize(dataset.shape)
+            dataset = dataset + prev_dataset
+        else:
+            dataset[:prev_n_items, :prev_n_annotators] += self.dataset_tensor
+
+        # warm start: posteriors given the previous estimates, with new annotators initialized at the average ability
+        error_rates = np.concatenate([
+            init.theta,
+            np.broadcast_to(init.theta.mean(0), (self.n_annotators-prev_n_annotators, self.n_classes, self.n_classes))
+        ])
+        self._set_dataset(dataset)
+        predict_label, _ = self._get_posterior_and_likelihood(init.pi, error_rates)
+
+        pi, worker_abilities, worker_reliabilities, pred_labels = self._run(dataset, init=predict_label, max_iter=max_iter)
+
+        self.fitted_ = self._make_output(pi, worker_abilities, worker_reliabilities, pred_labels)
         return self.fitted_
     
     def fit_transform(
@@ -267,10 +695,245 @@ class DawidSkeneModel:
         out['posterior_label'] = out.idxmax(axis=1)
         return out
     
+    def predict_proba(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Compute posterior label class probabilities of (new) items given the fitted model's estimates
+
+        Runs a single E-step with the fitted label class prevalence and annotator abilities, without refitting.
+        Annotations by annotators or with labels the model has not been fitted on are ignored.
+
+        Args:
+        df: pd.DataFrame
+            DataFrame containing the annotations to score, with the same columns used in `fit`
+
+        Returns:
+        pd.DataFrame
+            posterior label class probabilities (items in rows, label classes in columns)
+        """
+        assert hasattr(self, 'fitted_'), "Model must be fitted before calling predict_proba"
+        for col in [self.items_col_, self.annotators_col_, self.annotations_col_]:
+            assert col in df.columns, f"Column '{col}' not found in DataFrame"
+
+        data = DawidSkeneModel._explode(df[[self.items_col_, self.annotators_col_, self.annotations_col_]], self.annotations_col_)
+        labels, _ = DawidSkeneModel._encode(data[self.annotations_col_], self.classes_)
+        annotators, _ = DawidSkeneModel._encode(data[self.annotators_col_], self.annotators_)
+        if self.verbose and (annotators < 0).any():
+            print(f"Ignoring annotations by {data.loc[annotators < 0, self.annotators_col_].nunique()} unknown annotator(s)")
+        items, item_ids = DawidSkeneModel._encode(data[self.items_col_])
+
+        dataset = self._build_dataset(items, annotators, labels, len(item_ids), self.n_annotators)
+        counts = dataset if issparse(dataset) else dataset.reshape(len(item_ids), -1)
+        posteriors, _ = self._get_posterior_and_likelihood(self.fitted_.pi, self.fitted_.theta, counts=counts)
+        return pd.DataFrame(posteriors, columns=self.classes_, index=item_ids)
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Compute posterior label class probabilities and labels of (new) items given the fitted model's estimates
+
+        See `predict_proba`. Output is formatted as in `fit_transform`.
+        """
+        out = self.predict_proba(df)
+        out['posterior_label'] = out.idxmax(axis=1)
+        return out
+
+    def save(self, path: str) -> None:
+        """
+        Save the fitted model (parameters, estimates and index mappings) to a compressed .npz file
+
+        The annotations the model has been fitted on are not saved, so a loaded model can
+        be used for scoring (`predict_proba`, `transform`) but not for `partial_fit` or `bootstrap`.
+        """
+        assert hasattr(self, 'fitted_'), "Model must be fitted before saving"
+        params = {
+            'n_classes': self.n_classes, 'max_iter': self.max_iter, 'tolerance': self.tolerance,
+            'verbose': self.verbose, 'sparse': self.sparse, 'n_restarts': self.n_restarts,
+            'n_jobs': self.n_jobs, 'random_state': self.random_state, 'acceleration': self.acceleration,
+            'dtype': str(self.dtype_),
+        }
+        columns = {'items_col': self.items_col_, 'annotators_col': self.annotators_col_, 'annotations_col': self.annotations_col_}
+        np.savez_compressed(
+            path,
+            params=json.dumps(params),
+            columns=json.dumps(columns),
+            classes=np.asarray(self.classes_),
+            items=np.asarray(self.items_),
+            annotators=np.asarray(self.annotators_),
+            pi=self.fitted_.pi,
+            theta=self.fitted_.theta,
+            z=self.fitted_.z,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'DawidSkeneModel':
+        """
+        Load a fitted model saved with `save`
+
+        Note: IDs stored as Python objects are unpickled, so only load files from trusted sources.
+        """
+        with np.load(path, allow_pickle=True) as f:
+            model = cls(**json.loads(str(f['params'])))
+            columns = json.loads(str(f['columns']))
+            model.items_col_, model.annotators_col_, model.annotations_col_ = columns['items_col'], columns['annotators_col'], columns['annotations_col']
+            model.classes_, model.items_, model.annotators_ = f['classes'], f['items'], f['annotators']
+            pi, theta, z = f['pi'], f['theta'], f['z']
+        model.dtype_ = theta.dtype
+
+        model.annotation_id2idx_ = {lid: idx for idx, lid in enumerate(model.classes_)}
+        model.n_items = len(model.items_)
+        model.item_id2idx_ = {pid: idx for idx, pid in enumerate(model.items_)}
+        model.n_annotators = len(model.annotators_)
+        model.annotator_id2idx_ = {cid: idx for idx, cid in enumerate(model.annotators_)}
+        model.fitted_ = model._make_output(pi, theta, dict(enumerate(model._get_worker_reliabilities(pi, theta))), z)
+        return model
+
+    def fit_batched(
+        self,
+        df: pd.DataFrame,
+        groups_col: str,
+        items_col: str,
+        annotators_col: str,
+        annotations_col: str
+    ) -> Dict[Hashable, DawidSkeneModelOutput]:
+        """
+        Fit independent Dawid-Skene models for many groups of annotations at once
+
+        The annotations of all groups are stacked into one sparse (items, annotators*classes) count
+        matrix in which every (group, item) and (group, annotator) combination has its own row and
+        column block, respectively, and EM runs for all groups together with vectorized operations.
+        Label class prevalences, log-likelihoods and the stopping rule are computed per group, so
+        each group's estimates are the same as those of fitting the group on its own (up to the
+        ordering of classes, which here follows `batch_classes_` across all groups).
+        Restarts and acceleration are not applied in batched fitting.
+        Results are stored in `fitted_batched_` and the `batch_*` attributes, so fitting a batch
+        does not affect the model fitted with `fit` (and its `predict_proba`, `partial_fit` and `bootstrap`).
+
+        Args:
+        df: pd.DataFrame
+            DataFrame containing the annotation data
+        groups_col: str
+            Name of column containing the group IDs (e.g., annotation group, language, or coding dimension)
+        items_col: str
+            Name of column containing the item IDs
+        annotators_col: str
+            Name of column containing the annotator IDs
+        annotations_col: str
+            Name of column containing the annotation labels
+
+        Returns:
+        Dict[Hashable, DawidSkeneModelOutput]
+            Output of fitted Dawid-Skene model by group. Rows of `z` are ordered as in `batch_items_[group]`
+            and rows of `theta` as in `batch_annotators_[group]`. Columns of `z` are ordered as in `batch_classes_`.
+        """
+        assert len(df) > 0, "DataFrame is empty"
+        for col in [groups_col, items_col, annotators_col, annotations_col]:
+            assert col in df.columns, f"Column '{col}' not found in DataFrame"
+
+        data = DawidSkeneModel._explode(df[[groups_col, items_col, annotators_col, annotations_col]], annotations_col)
+
+        # the batched problem is fitted on an internal model so that the state of `fit` is left untouched
+        model = DawidSkeneModel(self.n_classes, max_iter=self.max_iter, tolerance=self.tolerance, verbose=False, sparse=True, dtype=self.dtype)
+
+        labels, self.batch_classes_ = DawidSkeneModel._encode(data[annotations_col])
+        assert len(self.batch_classes_) > 1, "At least two labels are required"
+        assert len(self.batch_classes_) <= self.n_classes, f"Found {len(self.batch_classes_)} distinct labels but n_classes={self.n_classes}"
+        groups, self.batch_groups_ = DawidSkeneModel._encode(data[groups_col])
+        n_groups = len(self.batch_groups_)
+
+        # items and annotators are indexed by (group, ID) so that each group has its own rows/columns
+        item_codes, item_ids = DawidSkeneModel._encode(data[items_col])
+        items, item_keys = pd.factorize(groups*len(item_ids) + item_codes)
+        item_groups, item_ids = item_keys // len(item_ids), item_ids[item_keys % len(item_ids)]
+        annotator_codes, annotator_ids = DawidSkeneModel._encode(data[annotators_col])
+        annotators, annotator_keys = pd.factorize(groups*len(annotator_ids) + annotator_codes)
+        worker_groups, annotator_ids = annotator_keys // len(annotator_ids), annotator_ids[annotator_keys % len(annotator_ids)]
+        n_items = np.bincount(item_groups, minlength=n_groups)
+
+        self.batch_items_ = {group: item_ids[item_groups == g] for g, group in enumerate(self.batch_groups_)}
+        self.batch_annotators_ = {group: annotator_ids[worker_groups == g] for g, group in enumerate(self.batch_groups_)}
+
+        keep = labels >= 0
+        dtype = model._get_dtype(keep.sum())
+        dataset = DawidSkeneModel._triples2sparse(
+            self.n_classes, len(item_keys), len(annotator_keys), items[keep], annotators[keep], labels[keep],
+            counts=np.ones(keep.sum(), dtype=dtype)
+        )
+        model._set_dataset(dataset)
+        # (n_groups, n_items) indicator matrix for per-group segment sums over items
+        group_items = csr_matrix((np.ones(model.task_num, dtype=dtype), (item_groups, np.arange(model.task_num))), shape=(n_groups, model.task_num))
+
+        predict_label = model._get_default_init()
+        # estimates of each group at the iteration its stopping rule was met
+        final_pi = np.zeros((n_groups, self.n_classes), dtype=dtype)
+        final_error_rates = np.zeros((model.worker_num, self.n_classes, self.n_classes), dtype=dtype)
+        final_predict_label = np.zeros_like(predict_label)
+        active = np.ones(n_groups, dtype=bool)
+        n_iter = np.zeros(n_groups, dtype=int)
+        prev_error_rates, prev_marginal_predict = None, None
+        iter_num = 0
+
+        while active.any():
+            error_rates = model._m_step(predict_label)
+            marginal_predict = (np.asarray(group_items @ predict_label) / n_items[:, None]).astype(dtype)
+            with np.errstate(divide='ignore'):
+                log_joint = np.log(marginal_predict)[item_groups] + model._get_log_class_likelihood(error_rates)
+            next_predict_label = np.exp(log_joint - _logsumexp(log_joint, axis=1))
+
+            if iter_num > 0:
+                marginals_diff = np.abs(marginal_predict - prev_marginal_predict).sum(1)
+                error_rates_diff = np.bincount(worker_groups, weights=np.abs(error_rates - prev_error_rates).sum((1, 2)), minlength=n_groups)
+                stop = active & (((marginals_diff < self.tolerance) & (error_rates_diff < self.tolerance)) | (iter_num > self.max_iter))
+                if stop.any():
+                    final_pi[stop] = marginal_predict[stop]
+                    final_error_rates[stop[worker_groups]] = error_rates[stop[worker_groups]]
+                    final_predict_label[stop[item_groups]] = next_predict_label[stop[item_groups]]
+                    n_iter[stop] = iter_num + 1
+                    active &= ~stop
+
+            prev_error_rates = error_rates
+            prev_marginal_predict = marginal_predict
+            predict_label = next_predict_label
+            iter_num += 1
+
+        self.batch_iter_num_ = dict(zip(self.batch_groups_, n_iter))
+        reliabilities = np.einsum('wj,wjj->w', final_pi[worker_groups], final_error_rates)
+
+        self.fitted_batched_ = {}
+        for g, group in enumerate(self.batch_groups_):
+            workers = worker_groups == g
+            self.fitted_batched_[group] = DawidSkeneModelOutput(
+                final_pi[g],
+                final_error_rates[workers],
+                final_predict_label[item_groups == g],
+                dict(zip(self.batch_annotators_[group], reliabilities[workers]))
+            )
+        return self.fitted_batched_
+
+
+def _run_restart(seed):
+    model, dataset, gold = worker_state['model'], worker_state['dataset'], worker_state['gold']
+    init = None
+    if seed is not None:
+        model._set_dataset(dataset)
+        init = model._get_perturbed_init(seed)
+    pi, error_rates, worker_reliability, predict_label = model._run(dataset, gold=gold, init=init)
+    return pi, error_rates, worker_reliability, predict_label, model.log_likelihood_, model.iter_num, model.trace_
+
+def _run_bootstrap_replicate(seed):
+    model, counts, n_workers = worker_state['model'], worker_state['counts'], worker_state['n_workers']
+    rng = np.random.default_rng(seed)
+    idxs = rng.integers(0, counts.shape[0], size=counts.shape[0])
+    dataset = counts[idxs]
+    if not issparse(dataset):
+        dataset = dataset.reshape(len(idxs), n_workers, model.n_classes)
+    pi, error_rates, worker_reliability, _ = model._run(dataset, init=worker_state['init'][idxs], max_iter=worker_state['max_iter'])
+    reliabilities = np.array(list(worker_reliability.values()))
+    # workers without annotations in the replicate
+    reliabilities[np.asarray(counts[idxs].sum(0)).reshape(n_workers, -1).sum(1) == 0] = np.nan
+    return pi, reliabilities
 
 
 def compute_mv(x):
-    """Compute majoirty vote, assuming that there are only two label classes: 1 and 2"""
+    """Compute majoirty vote, assuming that there are only two label classes: 1 and 2 (see `majority_vote` for any number of classes)"""
     cnts = x.value_counts(sort=False).to_numpy()
     if len(cnts) == 1:
         return x.iloc[0]
@@ -281,6 +944,95 @@ def compute_mv(x):
     else:
         return 2
     
+def majority_vote(
+    df: pd.DataFrame,
+    items_col: str,
+    annotations_col: str,
+    annotators_col: Optional[str]=None,
+    weights: Optional[Union[dict, pd.Series]]=None,
+    tie_policy: str='none',
+    tie_label=None,
+    random_state: Optional[int]=None
+) -> pd.DataFrame:
+    """
+    Compute (weighted) majority/plurality vote labels for all items at once
+
+    Votes are counted with a single bincount over integer-coded items and labels,
+    so this works for any number of label classes and scales to millions of annotations.
+    Multi-label cells (lists of labels) count as one vote per label.
+
+    Args:
+    df: pd.DataFrame
+        DataFrame containing the annotation data (one row per annotation)
+    items_col: str
+        Name of column containing the item IDs
+    annotations_col: str
+        Name of column containing the annotation labels
+    annotators_col: str
+        Name of column containing the annotator IDs (required if `weights` are given)
+    weights: dict or pd.Series
+        Annotator weights mapping annotator IDs to vote weights (e.g., Dawid-Skene worker reliabilities).
+        If None, every vote has weight 1.
+    tie_policy: str
+        How to resolve ties between the most voted labels:
+        'none' assigns `tie_label`, 'first' the label that occurs first in `df`, 'random' a random one of the tied labels
+    tie_label:
+        Label assigned to tied items if `tie_policy` is 'none'
+    random_state: int
+        Seed for breaking ties if `tie_policy` is 'random'
+
+    Returns:
+    pd.DataFrame
+        indexed by item ID, with columns
+        'label' (the majority vote label), 'tie' (whether the most voted labels were tied),
+        'n_votes' (the items' total (weighted) votes), 'vote_share' (share of votes for the most voted label),
+        and 'entropy' (entropy of the items' vote distribution)
+    """
+    assert tie_policy in ('none', 'first', 'random'), "tie_policy must be 'none', 'first' or 'random'"
+    assert weights is None or annotators_col is not None, "annotators_col is required when using weights"
+
+    cols = [items_col, annotations_col] + ([annotators_col] if annotators_col is not None else [])
+    data = DawidSkeneModel._explode(df[cols], annotations_col)
+    data = data[data[annotations_col].notna()]
+    items, item_ids = DawidSkeneModel._encode(data[items_col])
+    labels, classes = DawidSkeneModel._encode(data[annotations_col])
+    n_items, n_classes = len(item_ids), len(classes)
+
+    if weights is not None:
+        w = data[annotators_col].map(weights).to_numpy(dtype=float)
+        assert not np.isnan(w).any(), "weights missing for some annotators"
+    else:
+        w = None
+
+    # (n_items, n_classes) vote counts
+    votes = np.bincount(items*n_classes + labels, weights=w, minlength=n_items*n_classes).reshape(n_items, n_classes).astype(float)
+    n_votes = votes.sum(1)
+    max_votes = votes.max(1)
+    is_max = np.isclose(votes, max_votes[:, None])
+    tie = is_max.sum(1) > 1
+
+    if tie_policy == 'random':
+        rng = np.random.default_rng(random_state)
+        winner = np.argmax(np.where(is_max, rng.random(votes.shape), -1.0), axis=1)
+    else:
+        # first label (in order of appearance) among the most voted
+        winner = np.argmax(is_max, axis=1)
+    label = pd.Series(classes[winner], index=item_ids, dtype=object)
+    if tie_policy == 'none':
+        label[tie] = tie_label
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = votes / n_votes[:, None]
+        entropy = -np.sum(np.where(shares > 0, shares*np.log(shares), 0.0), axis=1)
+
+    return pd.DataFrame({
+        'label': label,
+        'tie': tie,
+        'n_votes': n_votes,
+        'vote_share': max_votes / n_votes,
+        'entropy': entropy,
+    }, index=item_ids)
+
 
 from sklearn.metrics import precision_recall_fscore_support
 
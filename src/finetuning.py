@@ -374,6 +374,7 @@ def train_and_test(
     gradient_accumulation_steps: int = TrainingArguments.gradient_accumulation_steps,
     fp16_training: bool = True,
     eval_batch_size: int = TrainingArguments.per_device_eval_batch_size,
+    batch_eval_metrics: bool = False,
     weight_decay: float = TrainingArguments.weight_decay,
     early_stopping: bool = True,
     early_stopping_patience: int = 3,
@@ -420,6 +421,9 @@ def train_and_test(
             Whether to use mixed precision training. Defaults to True.
         eval_batch_size (int): 
             Batch size for evaluation. Defaults to TrainingArguments.per_device_eval_batch_size.
+        batch_eval_metrics (bool): 
+            Whether to call `compute_metrics` on each evaluation batch (with `compute_result=True` on the last one) 
+            instead of once on the concatenated predictions, e.g. with a `SequenceClassificationMetricsAccumulator`. Defaults to False.
         weight_decay (float): 
             Weight decay for the optimizer. Defaults to TrainingArguments.weight_decay.
         early_stopping (bool): 
@@ -459,6 +463,7 @@ def train_and_test(
         per_device_train_batch_size=train_batch_size,
         gradient_accumulation_steps=gradient_accumulation_steps,
         per_device_eval_batch_size=eval_batch_size,
+        batch_eval_metrics=batch_eval_metrics,
         weight_decay=weight_decay,
         optim='adamw_torch',
         # how to select "best" model
@@ -1,12 +1,10 @@
-import warnings
 import numpy as np
 
-from sklearn.metrics import precision_recall_fscore_support, balanced_accuracy_score, accuracy_score
 from seqeval.metrics import classification_report as seqeval_classification_report
 
 from transformers.trainer_utils import PredictionOutput
 
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 # Sentence classification
 
@@ -15,27 +13,76 @@ def parse_sequence_classifier_prediction_output(p: PredictionOutput):
     predictions = np.argmax(logits, axis=1)
     return labels, predictions
 
-def compute_sequence_classification_metrics_binary(
-        y_true: List[List[int]], 
-        y_pred: List[List[int]]
+def compute_confusion_matrix(y_true, y_pred, n_classes: int) -> np.ndarray:
+    """Count (true label, predicted label) pairs of integer labels in 0, ..., n_classes-1 into a (n_classes, n_classes) matrix"""
+    y_true, y_pred = np.asarray(y_true, dtype=np.int64).ravel(), np.asarray(y_pred, dtype=np.int64).ravel()
+    return np.bincount(y_true * n_classes + y_pred, minlength=n_classes**2).reshape(n_classes, n_classes)
+
+def _divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    # like sklearn's zero_division=0.0
+    numerator, denominator = np.asarray(numerator, dtype=float), np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+def _class_wise_scores(cm: np.ndarray):
+    tp = np.diag(cm)
+    pred_sum, true_sum = cm.sum(axis=0), cm.sum(axis=1)
+    return _divide(tp, pred_sum), _divide(tp, true_sum), _divide(2 * tp, true_sum + pred_sum), true_sum, pred_sum
+
+def sequence_classification_metrics_from_confusion_matrix(
+        cm: np.ndarray,
+        label2id: Optional[Dict[str, int]] = None,
+        binary: bool = False,
     ) -> Dict[str, float]:
-    
-    with warnings.catch_warnings():
-        warnings.filterwarnings('ignore')
-        # metrics
-        precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average='binary', zero_division=0.0)
-        acc_balanced = balanced_accuracy_score(y_true, y_pred)
-        acc_not_balanced = accuracy_score(y_true, y_pred)
+    """
+    Derive the metrics of `compute_sequence_classification_metrics_binary` (if `binary`) or
+    `compute_sequence_classification_metrics_multiclass` (with `label2id`) from a confusion matrix
+    (rows: true labels, columns: predicted labels)
 
-    result = {
+    Results equal sklearn's: macro averages and balanced accuracy only consider
+    labels that occur in the true labels or predictions (balanced accuracy: true labels).
+    """
+    precision, recall, f1, true_sum, pred_sum = _class_wise_scores(cm)
+    total = cm.sum()
+    present = (true_sum + pred_sum) > 0
+    acc_not_balanced = float(np.trace(cm) / total) if total else 0.0
+    acc_balanced = float(np.mean(recall[true_sum > 0])) if np.any(true_sum > 0) else 0.0
+
+    if binary:
+        return {
+            'accuracy': acc_not_balanced,
+            'accuracy_balanced': acc_balanced,
+            'f1': float(f1[1]),
+            'precision': float(precision[1]),
+            'recall': float(recall[1]),
+        }
+
+    tp_micro = np.trace(cm)
+    results = {
         'accuracy': acc_not_balanced,
         'accuracy_balanced': acc_balanced,
-        'f1': f1,
-        'precision': precision,
-        'recall': recall,
+        'f1_macro': float(np.mean(f1[present])),
+        'precision_macro': float(np.mean(precision[present])),
+        'recall_macro': float(np.mean(recall[present])),
+        'f1_micro': float(_divide(2 * tp_micro, true_sum[present].sum() + pred_sum[present].sum())),
+        'precision_micro': float(_divide(tp_micro, pred_sum[present].sum())),
+        'recall_micro': float(_divide(tp_micro, true_sum[present].sum())),
     }
 
-    return result
+    # by class metrics
+    for l, i in (label2id or {}).items():
+        results[f'precision_{l}'] = precision[i]
+        results[f'recall_{l}'] = recall[i]
+        results[f'f1_{l}'] = f1[i]
+
+    return results
+
+def compute_sequence_classification_metrics_binary(
+        y_true: List[List[int]], 
+        y_pred: List[List[int]]
+    ) -> Dict[str, float]:
+    
+    cm = compute_confusion_matrix(y_true, y_pred, n_classes=2)
+    return sequence_classification_metrics_from_confusion_matrix(cm, binary=True)
 
 def compute_sequence_classification_metrics_multiclass(
         y_true: List[List[int]], 
@@ -43,34 +90,63 @@ def compute_sequence_classification_metrics_multiclass(
         label2id: Dict[str, int]
     ) -> Dict[str, float]:
     
-    # overall metrics
-    with warnings.catch_warnings():
-        warnings.filterwarnings('ignore')
-        precision_macro, recall_macro, f1_macro, _ = precision_recall_fscore_support(y_true, y_pred, average='macro', zero_division=0.0)
-        precision_micro, recall_micro, f1_micro, _ = precision_recall_fscore_support(y_true, y_pred, average='micro', zero_division=0.0)
-        acc_balanced = balanced_accuracy_score(y_true, y_pred)
-        acc_not_balanced = accuracy_score(y_true, y_pred)
+    n_classes = max(max(label2id.values()), np.max(y_true, initial=0), np.max(y_pred, initial=0)) + 1
+    cm = compute_confusion_matrix(y_true, y_pred, n_classes=n_classes)
+    return sequence_classification_metrics_from_confusion_matrix(cm, label2id=label2id)
 
-    results = {
-        'accuracy': acc_not_balanced,
-        'accuracy_balanced': acc_balanced,
-        'f1_macro': f1_macro,
-        'precision_macro': precision_macro,
-        'recall_macro': recall_macro,
-        'f1_micro': f1_micro,
-        'precision_micro': precision_micro,
-        'recall_micro': recall_micro,
-    }
+def _to_numpy(x) -> np.ndarray:
+    if isinstance(x, (tuple, list)) and len(x) > 0 and not np.isscalar(x[0]):
+        x = x[0] # models returning several outputs: the first are the logits
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu()
+        x = x.float() if x.is_floating_point() else x # e.g. bfloat16 logits
+    return np.asarray(x)
 
-    # by class metrics
-    with warnings.catch_warnings():
-        precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average=None, labels=list(label2id.values()), zero_division=0.0)
-    for l, (p, r, f) in zip(label2id.keys(), zip(precision, recall, f1)):
-        results[f'precision_{l}'] = p
-        results[f'recall_{l}'] = r
-        results[f'f1_{l}'] = f
+class SequenceClassificationMetricsAccumulator:
+    """
+    Streaming sequence classification metrics
 
-    return results
+    Accumulates a (n_classes, n_classes) integer confusion matrix batch by batch, so the
+    evaluation set's logits need not be held in memory, and derives the metrics of
+    `compute_sequence_classification_metrics_binary`/`_multiclass` from it.
+
+    An instance can be passed as `compute_metrics` to a `Trainer` with
+    `TrainingArguments(batch_eval_metrics=True)`: it is called on every evaluation batch
+    and returns the metrics (and resets) when called with `compute_result=True`.
+
+    Args:
+        label2id (Dict[str, int]): 
+            Label mapping (for multiclass metrics with by-class results)
+        binary (bool): 
+            Compute binary metrics (positive label: 1) instead of multiclass ones
+    """
+    def __init__(self, label2id: Optional[Dict[str, int]] = None, binary: bool = False):
+        if not binary and label2id is None:
+            raise ValueError('label2id is required for multiclass metrics')
+        self.label2id = label2id
+        self.binary = binary
+        self.n_classes = 2 if binary else max(label2id.values()) + 1
+        self.reset()
+
+    def reset(self):
+        self.confusion_matrix = np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        self.confusion_matrix += compute_confusion_matrix(y_true, y_pred, self.n_classes)
+
+    def update_from_logits(self, logits, labels):
+        self.update(_to_numpy(labels), np.argmax(_to_numpy(logits), axis=-1))
+
+    def compute(self) -> Dict[str, float]:
+        return sequence_classification_metrics_from_confusion_matrix(self.confusion_matrix, label2id=self.label2id, binary=self.binary)
+
+    def __call__(self, p: PredictionOutput, compute_result: bool = True) -> Dict[str, float]:
+        self.update_from_logits(p.predictions, p.label_ids)
+        if not compute_result:
+            return {}
+        result = self.compute()
+        self.reset()
+        return result
 
 from sklearn.metrics import hamming_loss, accuracy_score, f1_score, label_ranking_loss
 
@@ -137,9 +213,93 @@ def _correct_iob2(labels: List[str]) -> List[str]:
             edit.append(i)
         prev = l
     if len(edit) > 0:
+        edit = set(edit)
         labels = [l.replace('I-', 'B-') if i in edit else l for i, l in enumerate(labels)]
     return labels
 
+def _flatten_token_labels(y_true, y_pred, sep: int):
+    """
+    Flatten (padded or ragged) sequences of label IDs, dropping positions labeled -100
+    and ending each sequence with the label ID `sep` (like seqeval, which joins sequences with 'O')
+    """
+    if isinstance(y_true, np.ndarray) and isinstance(y_pred, np.ndarray) and y_true.ndim == 2 and y_true.shape == y_pred.shape:
+        sep_col = np.full((y_true.shape[0], 1), sep)
+        mask = np.concatenate([y_true != -100, np.ones_like(sep_col, dtype=bool)], axis=1)
+        return np.concatenate([y_true, sep_col], axis=1)[mask], np.concatenate([y_pred, sep_col], axis=1)[mask]
+    trues, preds = [], []
+    for labs, preds_ in zip(y_true, y_pred):
+        n = min(len(labs), len(preds_))
+        labs, preds_ = np.asarray(labs, dtype=np.int64)[:n], np.asarray(preds_, dtype=np.int64)[:n]
+        mask = labs != -100
+        trues.append(np.append(labs[mask], sep))
+        preds.append(np.append(preds_[mask], sep))
+    if not trues:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(trues), np.concatenate(preds)
+
+def correct_iob2_codes(codes: np.ndarray, label_list: List[str]):
+    """
+    Vectorized `_correct_iob2` over a flattened sequence of label IDs (see `_flatten_token_labels`):
+    I- tags at the start of a sequence or after an 'O' become B- tags
+
+    Returns the corrected label IDs and the label list (extended by B- labels missing from it)
+    """
+    label_list = list(label_list)
+    is_o = np.array([l == 'O' for l in label_list])
+    is_i = np.array([l[0] == 'I' for l in label_list])
+    corrected = np.arange(len(label_list))
+    for i, l in enumerate(label_list[:len(corrected)]):
+        if is_i[i]:
+            b = l.replace('I-', 'B-')
+            if b not in label_list:
+                label_list.append(b)
+            corrected[i] = label_list.index(b)
+    # the flattened sequence starts after (and sequences are separated by) an 'O'
+    prev_is_o = np.concatenate([[True], is_o[codes[:-1]]])[:len(codes)]
+    edit = prev_is_o & is_i[codes]
+    return np.where(edit, corrected[codes], codes), label_list
+
+def extract_entity_spans(codes: np.ndarray, label_list: List[str]):
+    """
+    Vectorized `seqeval.metrics.sequence_labeling.get_entities` (default, i.e. conlleval-compatible mode)
+    over a flattened sequence of label IDs
+
+    Returns arrays of entity type names (in seqeval's notation) and the (type ID, start, end) of all entities
+    """
+    type_names, label_types = np.unique([l[1:].split('-', maxsplit=1)[-1] or '_' for l in label_list] + ['_'], return_inverse=True)
+    # seqeval processes the sequence followed by an 'O' (label ID len(label_list)), starting after tag 'O' with type '' (label ID len(label_list) + 1)
+    tags = np.array([l[0] for l in label_list] + ['O', 'O'])
+    label_types = np.append(label_types.ravel(), -1)
+    tag_in = lambda options: np.isin(tags, list(options))
+    codes = np.append(codes, len(label_list))
+    prev = np.concatenate([[len(label_list) + 1], codes[:-1]])
+
+    type_changed = label_types[prev] != label_types[codes]
+    end = (
+        tag_in('ES')[prev]
+        | (tag_in('BI')[prev] & tag_in('BSO')[codes])
+        | (~tag_in('O.')[prev] & type_changed)
+    )
+    start = (
+        tag_in('BS')[codes]
+        | (tag_in('ESO')[prev] & tag_in('EI')[codes])
+        | (~tag_in('O.')[codes] & type_changed)
+    )
+    # an entity ending before position i began at the last start before i (or at 0)
+    idx = np.arange(len(codes))
+    last_start = np.maximum.accumulate(np.where(start, idx, 0))
+    begin = np.concatenate([[0], last_start[:-1]])
+    ends = np.flatnonzero(end)
+    return type_names, np.column_stack([label_types[prev[ends]], begin[ends], ends - 1])
+
+def _span_scores(tp: np.ndarray, pred_sum: np.ndarray, true_sum: np.ndarray):
+    # like seqeval's precision_recall_fscore_support with zero_division=0
+    precision = np.divide(tp, pred_sum, out=np.zeros(len(tp)), where=pred_sum != 0)
+    recall = np.divide(tp, true_sum, out=np.zeros(len(tp)), where=true_sum != 0)
+    denom = precision + recall
+    denom[denom == 0.] = 1
+    return precision, recall, 2 * precision * recall / denom
+
 def parse_token_classifier_prediction_output(p: PredictionOutput):
     predictions, labels = p
     predictions = np.argmax(predictions, axis=2)
@@ -150,10 +310,21 @@ def compute_token_classification_metrics(
         y_true: List[List[int]], 
         y_pred: List[List[int]], 
         label2id: Dict[str, int], 
+        use_seqeval: bool = False,
     ) -> Dict[str, float]:
+    """
+    Compute span-level precision, recall and F1 per entity type and their macro and micro averages
+
+    Label IDs are decoded, I- tags after 'O' are repaired to B- tags, and spans are extracted and
+    scored with NumPy, with results identical to seqeval's `classification_report` in default mode.
+    Set `use_seqeval` to compute them with seqeval instead.
+    """
     
     label_list = list(label2id.keys())
     types = list(set([l[2:] for l in label_list if l != 'O']))
+
+    if not use_seqeval:
+        return _compute_token_classification_metrics_numpy(y_true, y_pred, label_list, types)
     
     # encode label IDs to labels
     predictions = [
@@ -183,4 +354,43 @@ def compute_token_classification_metrics(
         for m in metrics
     }
     
-    return result
\ No newline at end of file
+    return result
+
+def _compute_token_classification_metrics_numpy(y_true, y_pred, label_list: List[str], types: List[str]) -> Dict[str, float]:
+    # label ID len(label_list) marks sequence boundaries (as 'O')
+    true_codes, pred_codes = _flatten_token_labels(y_true, y_pred, sep=len(label_list))
+    label_list = label_list + ['O']
+    true_codes, true_labels = correct_iob2_codes(true_codes, label_list)
+    pred_codes, pred_labels = correct_iob2_codes(pred_codes, label_list)
+    true_names, true_spans = extract_entity_spans(true_codes, true_labels)
+    pred_names, pred_spans = extract_entity_spans(pred_codes, pred_labels)
+
+    # encode entities as unique integer keys over a shared, sorted list of type names
+    target_names = np.union1d(true_names[np.unique(true_spans[:, 0])], pred_names[np.unique(pred_spans[:, 0])])
+    n = len(true_codes) + 2
+    def encode(names, spans):
+        type_ids = np.searchsorted(target_names, names[spans[:, 0]])
+        # chunks never overlap, so keys are already unique
+        return np.sort((type_ids * n + spans[:, 1]) * n + spans[:, 2])
+    true_keys, pred_keys = encode(true_names, true_spans), encode(pred_names, pred_spans)
+    n_types = len(target_names)
+    tp = np.bincount(np.intersect1d(true_keys, pred_keys, assume_unique=True) // (n * n), minlength=n_types)
+    pred_sum = np.bincount(pred_keys // (n * n), minlength=n_types)
+    true_sum = np.bincount(true_keys // (n * n), minlength=n_types)
+
+    precision, recall, f1 = _span_scores(tp, pred_sum, true_sum)
+    result = {}
+    for name, p, r, f in zip(target_names, precision, recall, f1):
+        result[name] = {'precision': p, 'recall': r, 'f1-score': f}
+    micro = _span_scores(tp.sum(keepdims=True), pred_sum.sum(keepdims=True), true_sum.sum(keepdims=True))
+    result['micro avg'] = dict(zip(['precision', 'recall', 'f1-score'], [float(m[0]) for m in micro]))
+    result['macro avg'] = dict(zip(['precision', 'recall', 'f1-score'], [np.average(m) if n_types else np.nan for m in (precision, recall, f1)]))
+
+    metrics = ['precision', 'recall', 'f1-score']
+    keys = ['macro avg', 'micro avg'] + types
+    result = {k: result[k] for k in keys if k in result}
+    return {
+        str(f"{k.replace(' avg', '')}_{m.replace('f1-score', 'f1')}"): scores[m] 
+        for k, scores in result.items()
+        for m in metrics
+    }
@@ -0,0 +1,29 @@
+import os
+from concurrent.futures import ProcessPoolExecutor as Pool
+
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# read-only state shared by the tasks of a worker process (set once per process by `_init_worker`)
+worker_state = {}
+
+def _init_worker(state: Dict[str, Any]) -> None:
+    worker_state.clear()
+    worker_state.update(state)
+
+def map_with_shared_state(fn: Callable, args: Iterable, state: Dict[str, Any], n_jobs: Optional[int] = None) -> List:
+    """
+    Apply `fn` to `args` sequentially or in `n_jobs` worker processes that receive `state` only once at start-up
+
+    `fn` reads the shared state from `worker_state` (which is cleared again afterwards).
+    `n_jobs` of None or 1 runs sequentially in the current process, -1 uses all CPU cores.
+    """
+    args = list(args)
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    try:
+        if n_jobs is None or n_jobs <= 1:
+            _init_worker(state)
+            return [fn(arg) for arg in args]
+        with Pool(max_workers=min(n_jobs, len(args)), initializer=_init_worker, initargs=(state,)) as pool:
+            return list(pool.map(fn, args))
+    finally:
+        worker_state.clear()